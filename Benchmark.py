@@ -0,0 +1,196 @@
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+from Bot import HOST, Bot, BotStats
+
+PORT = 5600
+RESULTS_PATH = "benchmark_results.jsonl"
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+# CPU seconds and RSS of the server process and its workers, from psutil
+# when installed and /proc otherwise (None on platforms without either)
+def process_usage(pid):
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+    if psutil is not None:
+        parent = psutil.Process(pid)
+        cpu = rss = 0
+        for process in [parent] + parent.children():
+            times = process.cpu_times()
+            cpu += times.user + times.system
+            rss += process.memory_info().rss
+        return cpu, rss
+    try:
+        cpu = rss = 0
+        for process in [pid] + child_pids(pid):
+            with open(f"/proc/{process}/stat") as f:
+                # Fields after the process name, which may itself contain spaces
+                fields = f.read().rsplit(")", 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+            with open(f"/proc/{process}/status") as f:
+                rss += next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmRSS:"))
+        return cpu, rss
+    except (OSError, StopIteration):
+        return None
+
+
+def child_pids(pid):
+    children = []
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    if int(f.read().rsplit(")", 1)[1].split()[1]) == pid:
+                        children.append(int(entry))
+            except OSError:
+                pass
+    return children
+
+
+def raise_file_limit():
+    # Thousands of bots need thousands of sockets on both ends; the server
+    # subprocess inherits the raised limit
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def start_server(port, threaded=False, verbose=False, workers=0, journal="", board="3x3:3"):
+    # Readiness is read from the server's own startup line: a probe
+    # connection would take a seat on the two-player threaded server
+    command = [sys.executable, "-u", "Serveur.py", "--port", str(port), "--journal", journal, "--board", board]
+    if workers:
+        command += ["--workers", str(workers)]
+    elif not threaded:
+        command.append("--async")
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    for line in server.stdout:
+        if verbose:
+            print(line, end="")
+        if "started on" in line:
+            # Keep draining so a chatty server never blocks on a full pipe
+            threading.Thread(target=drain, args=(server.stdout, verbose), daemon=True).start()
+            return server
+    server.wait()
+    raise RuntimeError(f"Server exited with code {server.returncode}")
+
+
+def drain(stream, verbose):
+    for line in stream:
+        if verbose:
+            print(line, end="")
+
+
+async def run_benchmark(bots, port, games, ai, delta, ramp, think_time):
+    stats = BotStats()
+    tasks = []
+    start = time.perf_counter()
+    # Bots are started in waves of `ramp` per tick so the listen backlog
+    # is not the only thing being measured
+    for i in range(bots):
+        bot = Bot(stats, games=games, ai=ai, delta=delta, think_time=think_time, seed=i)
+        tasks.append(asyncio.create_task(bot.run(HOST, port)))
+        if ramp and (i + 1) % ramp == 0:
+            await asyncio.sleep(0.01)
+    await asyncio.gather(*tasks)
+    return stats, time.perf_counter() - start
+
+
+def summarize(stats, elapsed, usage_before, usage_after):
+    result = {
+        "bots": len(stats.connect_times) + stats.failures,
+        "connected": len(stats.connect_times),
+        "failures": stats.failures,
+        "elapsed_s": round(elapsed, 3),
+        "connect_p50_ms": round(percentile(stats.connect_times, 0.50) * 1000, 3),
+        "connect_p99_ms": round(percentile(stats.connect_times, 0.99) * 1000, 3),
+        "connections_per_s": round(len(stats.connect_times) / elapsed, 1) if elapsed else 0.0,
+        "moves": len(stats.move_rtts),
+        "rtt_p50_ms": round(percentile(stats.move_rtts, 0.50) * 1000, 3),
+        "rtt_p95_ms": round(percentile(stats.move_rtts, 0.95) * 1000, 3),
+        "rtt_p99_ms": round(percentile(stats.move_rtts, 0.99) * 1000, 3),
+        "rtt_max_ms": round(max(stats.move_rtts, default=0.0) * 1000, 3),
+        "games": stats.games,
+        "games_per_s": round(stats.games / elapsed, 1) if elapsed else 0.0,
+    }
+    if usage_before and usage_after:
+        cpu = usage_after[0] - usage_before[0]
+        result["server_cpu_s"] = round(cpu, 3)
+        result["server_cpu_pct"] = round(100 * cpu / elapsed, 1) if elapsed else 0.0
+        result["server_rss_mb"] = round(usage_after[1] / 2 ** 20, 1)
+    return result
+
+
+def report(result):
+    print(f"{result['connected']}/{result['bots']} bots connected "
+          f"({result['connections_per_s']}/s, p50 {result['connect_p50_ms']} ms, "
+          f"p99 {result['connect_p99_ms']} ms), {result['failures']} failures")
+    print(f"{result['moves']} moves: RTT p50 {result['rtt_p50_ms']} ms, p95 {result['rtt_p95_ms']} ms, "
+          f"p99 {result['rtt_p99_ms']} ms, max {result['rtt_max_ms']} ms")
+    print(f"{result['games']} games in {result['elapsed_s']} s ({result['games_per_s']}/s)")
+    if "server_cpu_s" in result:
+        print(f"Server: {result['server_cpu_s']} s CPU ({result['server_cpu_pct']}%), "
+              f"{result['server_rss_mb']} MB RSS")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the Tic Tac Toe server with headless bots")
+    parser.add_argument("--bots", type=int, default=1000)
+    parser.add_argument("--games", type=int, default=5, help="games per bot")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--ai", action="store_true", help="every bot plays the server AI")
+    parser.add_argument("--no-delta", action="store_true", help="ask for full STATE broadcasts")
+    parser.add_argument("--ramp", type=int, default=200, help="bots started per 10 ms (0: all at once)")
+    parser.add_argument("--think-ms", type=float, default=0.0, help="delay before each move")
+    parser.add_argument("--threaded", action="store_true", help="benchmark the threaded server (2 bots)")
+    parser.add_argument("--workers", type=int, default=0, help="benchmark a server with worker processes")
+    parser.add_argument("--journal", default="", help="let the server record games to this file")
+    parser.add_argument("--board", default="3x3:3", help="board size and win length, e.g. 15x15:5")
+    parser.add_argument("--external", action="store_true", help="use a server already listening on --port")
+    parser.add_argument("--verbose", action="store_true", help="show the server output")
+    parser.add_argument("--output", default=RESULTS_PATH, help="JSON lines file the run is appended to")
+    args = parser.parse_args()
+
+    limit = raise_file_limit()
+    # Each bot holds one socket here and one in the server
+    if not args.external and 2 * args.bots + 64 > limit:
+        print(f"Warning: {args.bots} bots may exceed the open file limit ({limit})")
+
+    bots = 2 if args.threaded else args.bots
+    server = None if args.external else start_server(args.port, args.threaded, args.verbose, args.workers, args.journal,
+                                                    args.board)
+    try:
+        usage_before = server and process_usage(server.pid)
+        stats, elapsed = asyncio.run(run_benchmark(
+            bots, args.port, args.games, args.ai, not args.no_delta, args.ramp, args.think_ms / 1000))
+        usage_after = server and process_usage(server.pid)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    result = summarize(stats, elapsed, usage_before, usage_after)
+    result.update(time=time.strftime("%Y-%m-%dT%H:%M:%S"), server="threaded" if args.threaded else "async",
+                  workers=args.workers, board=args.board,
+                  ai=args.ai, delta=not args.no_delta, games_per_bot=args.games)
+    report(result)
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(json.dumps(result) + "\n")
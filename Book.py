@@ -0,0 +1,108 @@
+import os
+import sys
+from Engine import CELLS, FULL, LEGAL_MOVES, WINNING, Position
+
+# Solved game table: every reachable position with its minimax value and
+# best move, one byte per position, indexed by the base-3 encoding of the
+# board (3^9 = 19683 bytes on disk).
+BOOK_PATH = "tictactoe_book.bin"
+TABLE_SIZE = 3 ** CELLS
+UNREACHABLE = 0xFF
+NO_MOVE = 0x0F
+
+# Base-3 weight of each 9-bit player mask, so indexing is two lookups
+BASE3 = tuple(sum(3 ** i for i in range(CELLS) if mask >> i & 1) for mask in range(1 << CELLS))
+
+
+def index_of(x, o):
+    return BASE3[x] + 2 * BASE3[o]
+
+
+def encode_entry(value, move):
+    # low nibble: best move (NO_MOVE when the game is over)
+    # bits 4-5: value for the side to move + 1 (0 loss, 1 draw, 2 win)
+    return (value + 1) << 4 | move
+
+
+def build():
+    table = bytearray([UNREACHABLE]) * TABLE_SIZE
+    scores = {}
+
+    # Negamax with memo. Scores favour quick wins and slow losses, so the
+    # stored move wins as fast as possible; the stored value is the sign.
+    def solve(me, other, plies):
+        key = (me, other)
+        if key in scores:
+            return scores[key]
+        if WINNING[other]:
+            score, move = -(10 - plies), NO_MOVE
+        elif me | other == FULL:
+            score, move = 0, NO_MOVE
+        else:
+            score, move = None, NO_MOVE
+            for cell in LEGAL_MOVES[me | other]:
+                child = -solve(other, me | 1 << cell, plies + 1)
+                if score is None or child > score:
+                    score, move = child, cell
+        scores[key] = score
+        x, o = (me, other) if plies % 2 == 0 else (other, me)
+        value = (score > 0) - (score < 0)
+        table[index_of(x, o)] = encode_entry(value, move)
+        return score
+
+    solve(0, 0, 0)
+    return table
+
+
+class Book:
+    def __init__(self, table):
+        self.table = table
+
+    def entry(self, position):
+        entry = self.table[index_of(position.x, position.o)]
+        if entry == UNREACHABLE:
+            raise KeyError(f"{position} is not a reachable position")
+        return entry
+
+    def value(self, position):
+        # -1, 0 or 1 for the side to move under perfect play
+        return (self.entry(position) >> 4) - 1
+
+    def best_move(self, position):
+        move = self.entry(position) & 0x0F
+        return None if move == NO_MOVE else move
+
+    def predict(self, obs):
+        # Same call shape as NumpyPolicy.predict on a batch of observations
+        return [self.best_move(Position.from_codes(codes)) for codes in obs]
+
+    def is_optimal(self, position, cell):
+        # True when playing cell keeps the best achievable result
+        child = position.copy()
+        child.play(cell)
+        return -self.value(child) == self.value(position)
+
+
+def load(path=BOOK_PATH):
+    # Built once (well under a second) and cached next to the model
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            table = f.read()
+        if len(table) == TABLE_SIZE:
+            return Book(table)
+    table = bytes(build())
+    try:
+        with open(path, "wb") as f:
+            f.write(table)
+    except OSError as e:
+        print(f"Could not save opening book to {path}: {e}")
+    return Book(table)
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else BOOK_PATH
+    table = build()
+    with open(path, "wb") as f:
+        f.write(table)
+    reachable = TABLE_SIZE - table.count(UNREACHABLE)
+    print(f"Solved {reachable} positions, saved to {path}")
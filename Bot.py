@@ -0,0 +1,141 @@
+import argparse
+import asyncio
+import random
+import time
+from Engine import CLASSIC, Position, Variant
+from Protocol import Decoder, ProtocolError, encode, encode_batch
+
+# Server configuration
+HOST = "127.0.0.1"
+PORT = 5555
+
+
+# Numbers gathered by every bot of a run
+class BotStats:
+    def __init__(self):
+        self.connect_times = []
+        self.move_rtts = []
+        self.games = 0
+        self.failures = 0
+
+
+# Headless player speaking the same protocol as Client.py. It plays random
+# legal moves and times each MOVE until the server's update comes back.
+class Bot:
+    def __init__(self, stats, games=1, ai=False, delta=True, think_time=0.0, seed=None):
+        self.stats = stats
+        self.games = games
+        self.ai = ai
+        self.delta = delta
+        self.think_time = think_time
+        self.rng = random.Random(seed)
+        self.variant = CLASSIC
+        self.board = Position()
+        self.player_id = None
+        self.turn = 0
+        self.game_over = True
+        self.games_done = 0
+        self.sent_at = None
+
+    def handle_message(self, data):
+        # Returns False when the bot should hang up
+        if data.startswith("RULES:"):
+            _, size, win = data.split(":")
+            self.variant = Variant(int(size), int(win))
+            self.board = Position(variant=self.variant)
+        elif data.startswith("ID:"):
+            # ID:n:token; bots never resume, so the token is not kept
+            self.player_id = int(data.split(":")[1])
+        elif data.startswith("STATE:"):
+            parts = data.split(":")
+            self.board = Position.from_cells(parts[1].split(","), self.variant)
+            self.turn = int(parts[2])
+            self.game_over = self.board.winner() is not None
+            self.move_acknowledged()
+        elif data.startswith("DELTA:"):
+            _, _, cell, symbol, turn = data.split(":")
+            self.board.play(int(cell), "XO".index(symbol))
+            self.turn = int(turn)
+            self.move_acknowledged()
+        elif data.startswith("RESULT:"):
+            self.game_over = True
+            self.games_done += 1
+            # Both seats see the RESULT of a game between two bots; only
+            # player 1 counts it, so games are counted once
+            if self.ai or self.player_id == 0:
+                self.stats.games += 1
+        elif data == "RESET":
+            self.game_over = False
+        elif data.startswith("DISCONNECT:") or data in ("FULL", "NOAI"):
+            return False
+        return True
+
+    def move_acknowledged(self):
+        if self.sent_at is not None:
+            self.stats.move_rtts.append(time.perf_counter() - self.sent_at)
+            self.sent_at = None
+
+    def next_messages(self):
+        if self.game_over:
+            # Player 1 (X) starts the next game once the previous one is over
+            if self.player_id == 0 and self.games_done < self.games and self.board.winner():
+                self.board = Position(variant=self.variant)
+                return ["RESET"]
+            return []
+        if self.sent_at is None and self.turn == self.player_id:
+            self.sent_at = time.perf_counter()
+            return [f"MOVE:{self.rng.choice(self.board.legal_moves())}"]
+        return []
+
+    async def run(self, host=HOST, port=PORT):
+        start = time.perf_counter()
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+        except OSError:
+            self.stats.failures += 1
+            return
+        self.stats.connect_times.append(time.perf_counter() - start)
+        hello = ["PLAY:AI" if self.ai else "PLAY"] + (["DELTA"] if self.delta else [])
+        writer.write(encode_batch(hello))
+        decoder = Decoder()
+        try:
+            while self.games_done < self.games:
+                chunk = await reader.read(4096)
+                if not chunk:
+                    break
+                if not all(self.handle_message(data) for data in decoder.feed(chunk)):
+                    break
+                messages = self.next_messages()
+                if messages:
+                    if self.think_time:
+                        await asyncio.sleep(self.think_time)
+                        if self.sent_at is not None:
+                            self.sent_at = time.perf_counter()
+                    writer.write(encode_batch(messages))
+                    await writer.drain()
+            # Leaving on purpose: the server frees the seat right away
+            # instead of holding it for a resume
+            writer.write(encode("QUIT"))
+        except (ConnectionError, ProtocolError):
+            self.stats.failures += 1
+        finally:
+            writer.close()
+
+
+async def run_bots(count, host=HOST, port=PORT, **bot_options):
+    stats = BotStats()
+    await asyncio.gather(*(Bot(stats, seed=i, **bot_options).run(host, port) for i in range(count)))
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless Tic Tac Toe bot players")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--bots", type=int, default=2)
+    parser.add_argument("--games", type=int, default=1, help="games per bot")
+    parser.add_argument("--ai", action="store_true", help="play against the server AI")
+    args = parser.parse_args()
+
+    stats = asyncio.run(run_bots(args.bots, args.host, args.port, games=args.games, ai=args.ai))
+    print(f"{stats.games} games played, {len(stats.move_rtts)} moves, {stats.failures} failures")
@@ -1,27 +1,36 @@
 import pygame
 import sys
+import argparse
+import errno
+import os
+import select
+import selectors
 import socket
 import threading
-from queue import Queue
-
-# Initialize pygame
-pygame.init()
+import time
+from Engine import CLASSIC, Position, Variant
+from Protocol import Decoder, ProtocolError, encode, encode_batch
+from Renderer import Renderer, load_image, open_window
 
 # Constants
 WIDTH, HEIGHT = 500, 500
 SQUARE_SIZE = 120
 MARGIN = 20
-FONT = pygame.font.Font(None, 40)
-
-# Load images
-try:
-    blank_image = pygame.image.load('Blank.png')
-    x_image = pygame.image.load('x.png')
-    o_image = pygame.image.load('o.png')
-    Background = pygame.image.load('NewBackground.jpeg')
-    Background = pygame.transform.scale(Background, (WIDTH, HEIGHT))
-except pygame.error:
-    print("Warning: Could not load one or more image files.")
+
+# Window, renderer and images are only set up by main(), so importing this
+# module opens no window and loads no asset
+win = None
+renderer = None
+square_sources = {}
+
+def load_assets():
+    # The background comes pre-scaled from the asset cache; the squares are
+    # scaled by the renderer once their size is known
+    try:
+        background = load_image('NewBackground.jpeg', (WIDTH, HEIGHT))
+        return background, {"X": load_image('x.png'), "O": load_image('o.png'), " ": load_image('Blank.png')}
+    except (pygame.error, OSError):
+        print("Warning: Could not load one or more image files.")
     blank_image = pygame.Surface((SQUARE_SIZE, SQUARE_SIZE))
     blank_image.fill((200, 200, 200))
     x_image = pygame.Surface((SQUARE_SIZE, SQUARE_SIZE))
@@ -31,228 +40,514 @@ except pygame.error:
     o_image = pygame.Surface((SQUARE_SIZE, SQUARE_SIZE))
     o_image.fill((200, 200, 200))
     pygame.draw.circle(o_image, (255, 0, 0), (SQUARE_SIZE//2, SQUARE_SIZE//2), SQUARE_SIZE//2-20, 5)
-    Background = pygame.Surface((WIDTH, HEIGHT))
-    Background.fill((50, 50, 50))
-
-# Create Pygame window
-win = pygame.display.set_mode((WIDTH, HEIGHT))
-pygame.display.set_caption('Tic Tac Toe')
-clock = pygame.time.Clock()
+    background = pygame.Surface((WIDTH, HEIGHT))
+    background.fill((50, 50, 50))
+    return background, {"X": x_image, "O": o_image, " ": blank_image}
 
 # Networking variables
 HOST = '127.0.0.1'
 PORT = 5555
+# python Client.py --ai asks the server for an AI opponent
+PLAY_AI = False
+# Reconnect attempts after a dropped connection, spread over the server's
+# grace period (it keeps our seat for about 15 s)
+RESUME_DELAYS = (0.2, 0.5, 1, 2, 3, 4, 4)
 client_socket = None
 player_id = None
+# Resume token received with our ID
+session_token = None
+quitting = False
 connected = False
 game_started = False
-
-# Queues for thread-safe communication
-move_queue = Queue()
-status_queue = Queue()
+# Sequence number of the last board update applied; None while a full
+# snapshot is awaited
+last_seq = None
+sync_requested = False
+
+# The socket is non-blocking and serviced from the game loop: server
+# messages are parsed and applied where they are read. Bytes the kernel did
+# not take yet wait in outbox, the socket is watched for writability until
+# it is empty.
+selector = selectors.DefaultSelector()
+decoder = Decoder()
+outbox = bytearray()
+# True until the non-blocking connect() completes
+connecting = False
+
+# The game loop sleeps in pygame.event.wait(), so a helper thread watches the
+# socket and posts NETWORK_READY when it can be read or written. It moves no
+# data: it only wakes the loop, which then does the I/O itself. Writing to
+# watch_wakeup interrupts its select() when the socket or the interest
+# changes.
+NETWORK_READY = pygame.event.custom_type()
+watch_lock = threading.Lock()
+watch_armed = threading.Event()
+watch_wakeup, watch_interrupt = socket.socketpair()
+# (socket, wants writability) the watcher selects on; watched is what the
+# loop last gave it and is cleared once it fires
+watch_target = (None, False)
+watched = None
+# Next reconnect attempt (time.monotonic()) and how many were made
+resume_at = None
+resume_attempts = 0
+
+def open_connection(hello):
+    global client_socket, connecting, decoder
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client_socket.setblocking(False)
+    error = client_socket.connect_ex((HOST, PORT))
+    if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+        client_socket.close()
+        client_socket = None
+        raise OSError(error, os.strerror(error))
+    connecting = True
+    decoder = Decoder()
+    outbox[:] = encode_batch(hello)
+    selector.register(client_socket, selectors.EVENT_READ | selectors.EVENT_WRITE)
+
+def close_connection():
+    global client_socket, connected, connecting
+    if client_socket is not None:
+        selector.unregister(client_socket)
+        client_socket.close()
+        client_socket = None
+    connected = connecting = False
+    outbox.clear()
 
 def connect_to_server():
-    global client_socket, connected, player_id
     try:
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client_socket.connect((HOST, PORT))
-        connected = True
-        print("Connected to server!")
-        threading.Thread(target=receive_data, daemon=True).start()
-    except Exception as e:
+        open_connection(["PLAY:AI" if PLAY_AI else "PLAY", "DELTA"])
+    except OSError as e:
         print(f"Failed to connect: {e}")
-        status_queue.put(f"Connection failed: {e}")
+        set_status(f"Connection failed: {e}")
+
+def connection_established():
+    global connected, connecting
+    connecting = False
+    connected = True
+    print("Reconnected, resuming the game" if resume_attempts else "Connected to server!")
+
+def connection_lost(reason):
+    # Gets our seat back after a network blip: the server answers RESUME with
+    # our ID and a full STATE, so no lobby and no new match
+    global resume_attempts
+    was_resuming = resume_attempts > 0
+    close_connection()
+    if quitting or session_token is None:
+        set_status(reason)
+        return
+    if not was_resuming:
+        print(f"{reason}, reconnecting")
+        set_status("Connection lost, reconnecting...")
+    schedule_resume()
+
+def schedule_resume():
+    global resume_at, resume_attempts
+    if resume_attempts >= len(RESUME_DELAYS):
+        resume_at = None
+        resume_attempts = 0
+        set_status("Disconnected from server")
+        return
+    resume_at = time.monotonic() + RESUME_DELAYS[resume_attempts]
+    resume_attempts += 1
+
+def resume_session():
+    global resume_at, last_seq, sync_requested
+    resume_at = None
+    last_seq = None
+    sync_requested = False
+    try:
+        open_connection([f"RESUME:{session_token}", "DELTA"])
+    except OSError as e:
+        print(f"Reconnect failed: {e}")
+        schedule_resume()
 
-def receive_data():
-    global player_id, game_started, connected
-    while connected:
+def send(message):
+    if client_socket is None:
+        return False
+    outbox.extend(encode(message))
+    if connected:
+        flush()
+    return True
+
+def flush():
+    # Writes what the kernel accepts now; the rest goes out when the socket
+    # is writable again
+    try:
+        sent = client_socket.send(outbox)
+    except (BlockingIOError, InterruptedError):
+        sent = 0
+    except OSError as e:
+        print(f"Error sending data: {e}")
+        connection_lost(f"Connection error: {e}")
+        return
+    del outbox[:sent]
+    events = selectors.EVENT_READ | (selectors.EVENT_WRITE if outbox else 0)
+    if selector.get_key(client_socket).events != events:
+        selector.modify(client_socket, events)
+
+def receive():
+    while client_socket is not None:
+        try:
+            chunk = client_socket.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            print(f"Error receiving data: {e}")
+            connection_lost(f"Connection error: {e}")
+            return
+        if not chunk:
+            connection_lost("Disconnected from server")
+            return
         try:
-            if client_socket:
-                data = client_socket.recv(1024*4).decode().strip()
-                if not data:
-                    status_queue.put("Disconnected from server")
-                    break
-
-                print(f"Received from server: {data}")
-
-                if data.startswith("ID:"):
-                    player_id = int(data.split(":")[1])
-                    status_queue.put(f"You are Player {player_id + 1} ({'X' if player_id == 0 else 'O'})")
-                    client_socket.send("READY".encode())
-
-                elif data.startswith("STATE:"):
-                    parts = data.split(":")
-                    board_data = parts[1].split(",")
-                    current_turn = int(parts[2])
-                    move_queue.put({"type": "state", "board": board_data, "turn": current_turn})
-                    game_started = True
-
-                elif data.startswith("RESULT:"):
-                    parts = data.split(":")
-                    if parts[1] == "TIE":
-                        status_queue.put("Game Over: It's a tie!")
-                    elif parts[1] == "WIN":
-                        winner = int(parts[2])
-                        if winner == player_id:
-                            status_queue.put("Game Over: You win!")
-                        else:
-                            status_queue.put("Game Over: You lose!")
-                    move_queue.put({"type": "result"})
-
-                elif data == "RESET":
-                    move_queue.put({"type": "reset"})
-                    status_queue.put("Game has been reset")
-
-                elif data == "FULL":
-                    status_queue.put("Server is full. Try again later.")
-                    break
-
-                elif data.startswith("DISCONNECT:"):
-                    status_queue.put("The other player has disconnected")
-                    break
-        except Exception as e:
+            messages = decoder.feed(chunk)
+        except ProtocolError as e:
             print(f"Error receiving data: {e}")
-            status_queue.put(f"Connection error: {e}")
-            break
-    print("Receive thread ended")
-    connected = False
+            connection_lost(f"Connection error: {e}")
+            return
+        for data in messages:
+            if not handle_server_message(data):
+                close_connection()
+                return
+
+def poll_network():
+    # Does whatever the socket is ready for, without waiting
+    ready = selector.select(0) if selector.get_map() else []
+    for key, mask in ready:
+        if connecting:
+            error = client_socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                message = os.strerror(error)
+                if resume_attempts:
+                    print(f"Reconnect failed: {message}")
+                    close_connection()
+                    schedule_resume()
+                else:
+                    print(f"Failed to connect: {message}")
+                    close_connection()
+                    set_status(f"Connection failed: {message}")
+                return
+            connection_established()
+        if mask & selectors.EVENT_WRITE and client_socket is not None:
+            flush()
+        if mask & selectors.EVENT_READ and client_socket is not None:
+            receive()
+    if resume_at is not None and time.monotonic() >= resume_at:
+        resume_session()
+
+def watch_network():
+    # Runs on the watcher thread: once armed, selects on the latest target
+    # until the socket is ready, then wakes the loop and waits to be re-armed
+    while True:
+        watch_armed.wait()
+        if watch_target is None:
+            return
+        if wait_for_socket():
+            pygame.event.post(pygame.event.Event(NETWORK_READY))
+
+def wait_for_socket():
+    while True:
+        with watch_lock:
+            if watch_target is None:
+                return False
+            watch_armed.clear()
+            sock, want_write = watch_target
+        reads = [watch_wakeup] + ([sock] if sock is not None else [])
+        writes = [sock] if sock is not None and want_write else []
+        try:
+            readable, writable, _ = select.select(reads, writes, [])
+        except (OSError, ValueError):
+            # The socket was closed under us; the loop arms us again
+            return False
+        if watch_wakeup not in readable:
+            return True
+        watch_wakeup.recv(4096)
+
+def arm_watcher():
+    # Points the watcher at the current socket, unless it already waits on
+    # exactly that
+    global watch_target, watched
+    target = (client_socket, connecting or bool(outbox))
+    if target == watched:
+        return
+    watched = target
+    with watch_lock:
+        watch_target = target
+        watch_armed.set()
+    watch_interrupt.send(b"\0")
+
+def stop_watcher(watcher):
+    # Before pygame.quit(): the watcher must not post events any more
+    global watch_target
+    with watch_lock:
+        watch_target = None
+        watch_armed.set()
+    watch_interrupt.send(b"\0")
+    watcher.join()
+
+def wait_timeout():
+    # Milliseconds until the next reconnect attempt; 0 waits for an event
+    if resume_at is None:
+        return 0
+    return max(1, int((resume_at - time.monotonic()) * 1000) + 1)
+
+def handle_server_message(data):
+    # Returns False when the connection should be dropped
+    global player_id, session_token, game_started, last_seq, sync_requested, game_over, board, resume_attempts
+    print(f"Received from server: {data}")
+
+    if data.startswith("RULES:"):
+        _, size, win = data.split(":")
+        if (int(size), int(win)) != (variant.size, variant.win):
+            layout_board(Variant(int(size), int(win)))
+
+    elif data.startswith("ID:"):
+        parts = data.split(":")
+        player_id = int(parts[1])
+        if len(parts) > 2:
+            session_token = parts[2]
+        # Seated again: a later drop gets the full set of reconnect attempts
+        resume_attempts = 0
+        set_status(f"You are Player {player_id + 1} ({'X' if player_id == 0 else 'O'})")
+        send("READY")
+
+    elif data.startswith("STATE:"):
+        parts = data.split(":")
+        if len(parts) > 3:
+            last_seq = int(parts[3])
+            sync_requested = False
+        update_board_from_server(parts[1].split(","))
+        set_turn(int(parts[2]))
+        game_started = True
+
+    elif data.startswith("DELTA:"):
+        _, seq, cell, symbol, turn = data.split(":")
+        if last_seq is not None and int(seq) == last_seq + 1:
+            last_seq = int(seq)
+            board.play(int(cell), "XO".index(symbol))
+            squares[int(cell)].set_content(symbol)
+            set_turn(int(turn))
+        elif not sync_requested:
+            # An update was missed: drop deltas until a full snapshot arrives
+            last_seq = None
+            sync_requested = True
+            send("SYNC")
+
+    elif data.startswith("RESULT:"):
+        parts = data.split(":")
+        if parts[1] == "TIE":
+            set_status("Game Over: It's a tie!")
+        elif parts[1] == "WIN":
+            winner = int(parts[2])
+            if winner == player_id:
+                set_status("Game Over: You win!")
+            else:
+                set_status("Game Over: You lose!")
+        game_over = True
+
+    elif data == "RESET":
+        game_over = False
+        board = Position(variant=variant)
+        for square in squares:
+            square.set_content(" ")
+        set_status("Game has been reset")
+
+    elif data == "FULL":
+        set_status("Server is full. Try again later.")
+        return False
 
-def send_move(position):
-    if not connected or client_socket is None:
+    elif data == "NOAI":
+        set_status("No AI on this server (start it with --async)")
         return False
-    try:
-        client_socket.send(f"MOVE:{position}".encode())
-        return True
-    except Exception as e:
-        print(f"Error sending move: {e}")
-        status_queue.put(f"Failed to send move: {e}")
+
+    elif data.startswith("AWAY:"):
+        set_status("Opponent lost connection, waiting for them...")
+
+    elif data.startswith("BACK:"):
+        if game_over:
+            set_status("Opponent is back")
+        set_turn(current_player)
+
+    elif data.startswith("DISCONNECT:"):
+        set_status("The other player has disconnected")
         return False
+    return True
+
+def send_move(position):
+    if not connected:
+        return False
+    return send(f"MOVE:{position}")
 
 def request_reset():
-    if connected and client_socket:
-        try:
-            client_socket.send("RESET".encode())
-            return True
-        except Exception as e:
-            print(f"Error requesting reset: {e}")
-            return False
-    return False
+    if not connected:
+        return False
+    return send("RESET")
 
 # Game state variables
 current_player = 0
 game_over = False
-board = [" " for _ in range(9)]
+# Board size and win length, as announced by the server's RULES message
+variant = CLASSIC
+board = Position()
 status_message = "Connecting to server..."
 
 class Board(pygame.sprite.Sprite):
-    def __init__(self, position):
+    def __init__(self, position, size=SQUARE_SIZE):
         super().__init__()
         self.position = position
-        self.row = position // 3
-        self.col = position % 3
-        self.width = SQUARE_SIZE
-        self.height = SQUARE_SIZE
+        self.row = position // variant.size
+        self.col = position % variant.size
+        self.width = size
+        self.height = size
         self.x = self.col * self.width + MARGIN
         self.y = self.row * self.height + MARGIN
         self.content = ' '
-        self.image = pygame.transform.scale(blank_image, (self.width, self.height))
+        self.image = self.scaled_image()
         self.rect = self.image.get_rect()
         self.rect.topleft = (self.x, self.y)
 
+    def scaled_image(self):
+        return renderer.scaled_image(self.content, square_sources[self.content], (self.width, self.height))
+
     def update(self):
-        if self.content == "X":
-            self.image = pygame.transform.scale(x_image, (self.width, self.height))
-        elif self.content == "O":
-            self.image = pygame.transform.scale(o_image, (self.width, self.height))
-        else:
-            self.image = pygame.transform.scale(blank_image, (self.width, self.height))
+        self.image = self.scaled_image()
+        renderer.draw_sprite(self)
+
+    def set_content(self, content):
+        # Only squares that really changed are redrawn
+        if content != self.content:
+            self.content = content
+            self.update()
 
 def update_board_from_server(board_data):
+    global board
+    board = Position.from_cells(board_data, variant)
     for i, value in enumerate(board_data):
-        board[i] = value
-        squares[i].content = value
-        squares[i].update()
+        squares[i].set_content(value)
+
+def layout_board(new_variant):
+    # Larger boards get smaller squares, filling the area of the classic
+    # 3x3 grid
+    global variant, board, squares, square_size
+    variant = new_variant
+    board = Position(variant=variant)
+    square_size = 3 * SQUARE_SIZE // variant.size
+    squares = [Board(i, square_size) for i in range(variant.cells)]
+    renderer.invalidate()
+
+def cell_at(pos):
+    # Square under the mouse, or None outside the grid
+    col, row = (pos[0] - MARGIN) // square_size, (pos[1] - MARGIN) // square_size
+    if pos[0] >= MARGIN and pos[1] >= MARGIN and col < variant.size and row < variant.size:
+        return row * variant.size + col
+    return None
+
+def paint_reset_button(surface):
+    pygame.draw.rect(surface, reset_button_color, reset_button_rect, border_radius=10)
+    surface.blit(reset_button_text, reset_button_text_rect)
 
 def update_display():
-    win.blit(Background, (0, 0))
-    square_group.draw(win)
-
-    text = FONT.render(status_message, True, (255, 255, 255))
-    text_rect = text.get_rect(center=(WIDTH // 2, HEIGHT - 30))
-    win.blit(text, text_rect)
-
+    renderer.begin_frame(squares)
+    renderer.show_text("status", status_message, center=(WIDTH // 2, HEIGHT - 30))
     if game_over:
-        pygame.draw.rect(win, reset_button_color, reset_button_rect, border_radius=10)
-        win.blit(reset_button_text, reset_button_text_rect)
-
-    pygame.display.update()
-
-def process_network_messages():
-    global current_player, game_over, status_message
-    while not status_queue.empty():
-        status_message = status_queue.get()
-    while not move_queue.empty():
-        data = move_queue.get()
-        if data["type"] == "state":
-            update_board_from_server(data["board"])
-            current_player = data["turn"]
-            if player_id is not None:
-                if current_player == player_id:
-                    status_message = "Your turn!"
-                else:
-                    status_message = "Opponent's turn..."
-        elif data["type"] == "reset":
-            game_over = False
-            board[:] = [" " for _ in range(9)]
-            for square in squares:
-                square.content = " "
-                square.update()
-        elif data["type"] == "result":
-            game_over = True
-
-# Create board squares
-square_group = pygame.sprite.Group()
-squares = []
-for i in range(9):
-    sq = Board(i)
-    square_group.add(sq)
-    squares.append(sq)
+        renderer.show("reset", True, reset_button_rect, paint_reset_button)
+    else:
+        renderer.hide("reset")
+    renderer.flush()
+
+def set_status(message):
+    global status_message
+    status_message = message
+
+def set_turn(turn):
+    global current_player, status_message
+    current_player = turn
+    if player_id is not None and not game_over:
+        if current_player == player_id:
+            status_message = "Your turn!"
+        else:
+            status_message = "Opponent's turn..."
 
-# Connect to the server
-connect_to_server()
+squares = []
+square_size = SQUARE_SIZE
 
-# Add reset button
+# Reset button, drawn once the game is over
 reset_button_rect = pygame.Rect(WIDTH - 120, HEIGHT - 60, 100, 40)
 reset_button_color = (70, 70, 180)
-reset_button_text = FONT.render("Reset", True, (255, 255, 255))
-reset_button_text_rect = reset_button_text.get_rect(center=reset_button_rect.center)
+reset_button_text = None
+reset_button_text_rect = None
+
+def main(argv=None):
+    global win, renderer, square_sources, PLAY_AI, HOST, PORT, quitting, watched
+    global reset_button_text, reset_button_text_rect
+    parser = argparse.ArgumentParser(description="Tic Tac Toe network client")
+    parser.add_argument("--ai", action="store_true", help="ask the server for an AI opponent")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--headless", action="store_true",
+                        help="no window: draw offscreen with SDL's dummy video driver")
+    args = parser.parse_args(argv)
+    PLAY_AI, HOST, PORT = args.ai, args.host, args.port
+
+    # Connecting first lets the handshake run while the window is set up
+    connect_to_server()
+    win = open_window((WIDTH, HEIGHT), 'Tic Tac Toe', args.headless)
+    background, square_sources = load_assets()
+    renderer = Renderer(win, background, pygame.font.Font(None, 40))
+    layout_board(variant)
+    reset_button_text = renderer.render_text("Reset")
+    reset_button_text_rect = reset_button_text.get_rect(center=reset_button_rect.center)
+
+    # Nothing in this window reacts to mouse motion, so it should not wake us up
+    pygame.event.set_blocked(pygame.MOUSEMOTION)
+
+    # Game loop: does the pending socket I/O, then sleeps in
+    # pygame.event.wait() until there is input, the watcher reports the
+    # socket ready or a reconnect is due, and redraws what changed
+    watcher = threading.Thread(target=watch_network, daemon=True)
+    watcher.start()
+    run = True
+    update_display()
+    while run:
+        poll_network()
+        arm_watcher()
+        for event in [pygame.event.wait(wait_timeout())] + pygame.event.get():
+            if event.type == pygame.QUIT:
+                run = False
 
-# Game loop
-run = True
-while run:
-    clock.tick(60)
-    process_network_messages()
+            if event.type == NETWORK_READY:
+                watched = None
 
-    for event in pygame.event.get():
-        if event.type == pygame.QUIT:
-            run = False
+            if event.type in (pygame.VIDEOEXPOSE, pygame.WINDOWEXPOSED):
+                renderer.invalidate()
 
-        if event.type == pygame.MOUSEBUTTONDOWN:
-            mouse_pos = pygame.mouse.get_pos()
+            if event.type == pygame.MOUSEBUTTONDOWN:
+                mouse_pos = event.pos
 
-            if reset_button_rect.collidepoint(mouse_pos) and game_over:
-                request_reset()
+                if reset_button_rect.collidepoint(mouse_pos) and game_over:
+                    request_reset()
 
-            if (player_id is not None and current_player == player_id and not game_over 
-                    and game_started and connected):
-                for square in squares:
-                    if square.rect.collidepoint(mouse_pos) and square.content == ' ':
-                        if send_move(square.position):
-                            pass
+                if (player_id is not None and current_player == player_id and not game_over 
+                        and game_started and connected):
+                    cell = cell_at(mouse_pos)
+                    if cell is not None and board.is_free(cell):
+                        send_move(cell)
 
-    update_display()
+        update_display()
 
-pygame.quit()
-if client_socket:
-    client_socket.close()
-sys.exit()
+    stop_watcher(watcher)
+    pygame.quit()
+    quitting = True
+    if connected:
+        try:
+            # Tells the server not to keep our seat for a resume; whatever is
+            # still queued goes out first
+            client_socket.settimeout(1)
+            client_socket.sendall(outbox + encode("QUIT"))
+        except OSError:
+            pass
+    close_connection()
+
+if __name__ == "__main__":
+    main()
+    sys.exit()
@@ -0,0 +1,215 @@
+# Bitboard game engine shared by the servers, the client and the AI.
+# A position is two integers, one per player, with bit i set when that
+# player owns cell i, cells being numbered row by row. On the classic board:
+#  0 | 1 | 2
+#  3 | 4 | 5
+#  6 | 7 | 8
+# Larger boards (a Variant, e.g. 15x15 with 5 in a row) use the same
+# layout; Python integers hold any number of cells.
+
+CELLS = 9
+FULL = (1 << CELLS) - 1
+SYMBOLS = ("X", "O")
+
+LINES = (
+    0b000000111, 0b000111000, 0b111000000,  # rows
+    0b001001001, 0b010010010, 0b100100100,  # columns
+    0b100010001, 0b001010100,               # diagonals
+)
+
+# Lookup tables indexed by a 9-bit mask, so win detection and move
+# generation on the classic board are a single index instead of a board
+# scan. The solved book and the vectorized environment use them directly.
+WINNING = tuple(any(mask & line == line for line in LINES) for mask in range(1 << CELLS))
+LEGAL_MOVES = tuple(tuple(i for i in range(CELLS) if not mask >> i & 1) for mask in range(1 << CELLS))
+POPCOUNT = tuple(bin(mask).count("1") for mask in range(1 << CELLS))
+
+
+# Board size and number of marks in a row that wins. Every line of `win`
+# cells is listed once, and each cell knows the lines through it, so after
+# a move only those (at most 4 * win) are checked, whatever the board size.
+class Variant:
+    def __init__(self, size=3, win=3):
+        if not 1 <= win <= size:
+            raise ValueError(f"cannot win with {win} in a row on a {size}x{size} board")
+        self.size = size
+        self.win = win
+        self.cells = size * size
+        self.full = (1 << self.cells) - 1
+        lines = []
+        for row in range(size):
+            for col in range(size):
+                for drow, dcol in ((0, 1), (1, 0), (1, 1), (1, -1)):
+                    end_row, end_col = row + drow * (win - 1), col + dcol * (win - 1)
+                    if 0 <= end_row < size and 0 <= end_col < size:
+                        lines.append(tuple((row + drow * i) * size + col + dcol * i for i in range(win)))
+        self.lines = tuple(lines)
+        self.line_masks = tuple(sum(1 << cell for cell in line) for line in lines)
+        through = [[] for _ in range(self.cells)]
+        for line, mask in zip(lines, self.line_masks):
+            for cell in line:
+                through[cell].append(mask)
+        self.lines_through = tuple(map(tuple, through))
+
+    @classmethod
+    def parse(cls, text):
+        # "15x15:5", "15:5" or "4" (win length defaults to min(size, 5))
+        size, _, win = text.partition(":")
+        size = int(size.partition("x")[0])
+        return cls(size, int(win) if win else min(size, 5))
+
+    def __eq__(self, other):
+        return isinstance(other, Variant) and (self.size, self.win) == (other.size, other.win)
+
+    def __hash__(self):
+        return hash((self.size, self.win))
+
+    def __str__(self):
+        return f"{self.size}x{self.size}:{self.win}"
+
+    def __repr__(self):
+        return f"Variant({self.size}, {self.win})"
+
+    def rules_message(self):
+        # Sent to clients before their ID, so they can lay out the board
+        return f"RULES:{self.size}:{self.win}"
+
+    def wins_at(self, mask, cell):
+        # Whether the mark just put on cell completed a line
+        return any(mask & line == line for line in self.lines_through[cell])
+
+    def wins(self, mask):
+        return any(mask & line == line for line in self.line_masks)
+
+    def winner_of(self, x, o):
+        # Full scan, for positions that were not built move by move
+        if self.wins(x):
+            return "X"
+        if self.wins(o):
+            return "O"
+        if x | o == self.full:
+            return "TIE"
+        return None
+
+
+CLASSIC = Variant(3, 3)
+
+
+def winner_of(x, o):
+    if WINNING[x]:
+        return "X"
+    if WINNING[o]:
+        return "O"
+    if x | o == FULL:
+        return "TIE"
+    return None
+
+
+class Position:
+    # won caches the symbol of a completed line, kept up to date by play()
+    __slots__ = ("x", "o", "variant", "won")
+
+    def __init__(self, x=0, o=0, variant=CLASSIC):
+        self.x = x
+        self.o = o
+        self.variant = variant
+        self.won = None
+        if x or o:
+            result = variant.winner_of(x, o)
+            self.won = result if result != "TIE" else None
+
+    @classmethod
+    def from_cells(cls, cells, variant=CLASSIC):
+        if len(cells) != variant.cells:
+            raise ValueError(f"{len(cells)} cells for a {variant.size}x{variant.size} board")
+        x = o = 0
+        for i, cell in enumerate(cells):
+            if cell == "X":
+                x |= 1 << i
+            elif cell == "O":
+                o |= 1 << i
+        return cls(x, o, variant)
+
+    @classmethod
+    def from_codes(cls, codes, variant=CLASSIC):
+        x = o = 0
+        for i, code in enumerate(codes):
+            if code == 1:
+                x |= 1 << i
+            elif code == 2:
+                o |= 1 << i
+        return cls(x, o, variant)
+
+    def copy(self):
+        position = Position(variant=self.variant)
+        position.x, position.o, position.won = self.x, self.o, self.won
+        return position
+
+    def key(self):
+        return self.x << self.variant.cells | self.o
+
+    def __hash__(self):
+        return self.key()
+
+    def __eq__(self, other):
+        return (isinstance(other, Position) and self.x == other.x and self.o == other.o
+                and self.variant == other.variant)
+
+    def __repr__(self):
+        return f"Position({''.join(c if c != ' ' else '.' for c in self.cells())})"
+
+    @property
+    def turn(self):
+        # X always moves first, so O is to move whenever X has one more mark
+        return bin(self.x).count("1") - bin(self.o).count("1")
+
+    def is_free(self, cell):
+        return 0 <= cell < self.variant.cells and not (self.x | self.o) >> cell & 1
+
+    def legal_moves(self):
+        occupied = self.x | self.o
+        if self.variant.cells == CELLS:
+            return LEGAL_MOVES[occupied]
+        return tuple(i for i in range(self.variant.cells) if not occupied >> i & 1)
+
+    def play(self, cell, player=None):
+        if player is None:
+            player = self.turn
+        if player == 0:
+            self.x |= 1 << cell
+            if self.variant.wins_at(self.x, cell):
+                self.won = "X"
+        else:
+            self.o |= 1 << cell
+            if self.variant.wins_at(self.o, cell):
+                self.won = "O"
+
+    def undo(self, cell):
+        # Takes back the last move; no move is ever played after a win, so
+        # the position before it had no completed line
+        mask = ~(1 << cell)
+        self.x &= mask
+        self.o &= mask
+        self.won = None
+
+    def winner(self):
+        if self.won:
+            return self.won
+        if self.x | self.o == self.variant.full:
+            return "TIE"
+        return None
+
+    def cell(self, i):
+        if self.x >> i & 1:
+            return "X"
+        if self.o >> i & 1:
+            return "O"
+        return " "
+
+    def cells(self):
+        return [self.cell(i) for i in range(self.variant.cells)]
+
+    def codes(self):
+        # 0 empty, 1 X, 2 O: the observation layout used by TicTacToeEnv
+        x, o = self.x, self.o
+        return [(x >> i & 1) + 2 * (o >> i & 1) for i in range(self.variant.cells)]
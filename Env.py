@@ -0,0 +1,238 @@
+import multiprocessing
+
+import numpy as np
+from gymnasium import Env, spaces
+from stable_baselines3.common.vec_env import VecEnv
+from Engine import CLASSIC, WINNING, Position
+
+WIN_TABLE = np.array(WINNING, dtype=bool)
+ILLEGAL_MOVE_REWARD = -10
+
+
+class TicTacToeEnv(Env):
+    def __init__(self, variant=CLASSIC):
+        super(TicTacToeEnv, self).__init__()
+        self.variant = variant
+        self.action_space = spaces.Discrete(variant.cells)
+        self.observation_space = spaces.Box(low=0, high=2, shape=(variant.cells,), dtype=np.int32)
+        self.reset()
+
+    def reset(self, seed=None, options=None):
+        super().reset(seed=seed)
+        self.board = Position(variant=self.variant)
+        self.done = False
+        return self._get_obs(), {}
+
+    def _get_obs(self):
+        return np.array(self.board.codes(), dtype=np.int32)
+
+    def step(self, action):
+        action = int(action)
+        # Position.play only checks the lines through the new mark
+        if self.done or not self.board.is_free(action):
+            return self._get_obs(), ILLEGAL_MOVE_REWARD, True, False, {}
+
+        self.board.play(action)
+        winner = self._check_winner()
+        if winner:
+            self.done = True
+            reward = 1 if winner == "O" else -1 if winner == "X" else 0
+            return self._get_obs(), reward, True, False, {}
+
+        return self._get_obs(), 0, False, False, {}
+
+    def _check_winner(self):
+        return self.board.winner()
+
+    def action_masks(self):
+        # Free cells, in the form sb3_contrib's MaskablePPO asks for
+        return np.array(self.board.codes(), dtype=np.int32) == 0
+
+
+# Steps N boards at once with array operations. Same rules and rewards as
+# TicTacToeEnv; finished boards are reset automatically, as VecEnv expects,
+# and their last observation is returned in info["terminal_observation"].
+# The classic board keeps 9-bit masks and reads wins from WIN_TABLE; other
+# variants gather the cells of the lines through each move, padded with an
+# extra always-empty column so every cell has the same number of lines.
+class TicTacToeVecEnv(VecEnv):
+    render_mode = None
+
+    def __init__(self, num_envs=64, variant=CLASSIC):
+        cells = variant.cells
+        observation_space = spaces.Box(low=0, high=2, shape=(cells,), dtype=np.int32)
+        super().__init__(num_envs, observation_space, spaces.Discrete(cells))
+        self.variant = variant
+        self.x = np.zeros(num_envs, dtype=np.int64)
+        self.o = np.zeros(num_envs, dtype=np.int64)
+        self.turn = np.zeros(num_envs, dtype=np.int64)
+        self.filled = np.zeros(num_envs, dtype=np.int64)
+        self.board = np.zeros((num_envs, cells + 1), dtype=np.int32)
+        self.obs = self.board[:, :cells]
+        self.rows = np.arange(num_envs)
+        self.actions = None
+        through = [[line for line in variant.lines if cell in line] for cell in range(cells)]
+        self.line_cells = np.full((cells, max(map(len, through)), variant.win), cells)
+        for cell, lines in enumerate(through):
+            self.line_cells[cell, :len(lines)] = lines
+
+    def reset(self):
+        self.x[:] = 0
+        self.o[:] = 0
+        self.turn[:] = 0
+        self.filled[:] = 0
+        self.board[:] = 0
+        return self.obs.copy()
+
+    def step_async(self, actions):
+        self.actions = np.asarray(actions, dtype=np.int64).reshape(self.num_envs)
+
+    def step_wait(self):
+        actions = self.actions
+        illegal = self.obs[self.rows, actions] != 0
+        legal = ~illegal
+        x_moves = self.turn == 0
+        self.obs[self.rows[legal], actions[legal]] = self.turn[legal] + 1
+        self.filled += legal
+
+        if self.variant == CLASSIC:
+            bits = np.where(legal, np.left_shift(1, actions), 0)
+            self.x |= np.where(x_moves, bits, 0)
+            self.o |= np.where(x_moves, 0, bits)
+            won = legal & WIN_TABLE[np.where(x_moves, self.x, self.o)]
+        else:
+            marks = self.board[self.rows[:, None, None], self.line_cells[actions]]
+            won = legal & (marks == (self.turn + 1)[:, None, None]).all(-1).any(-1)
+        tie = legal & ~won & (self.filled == self.variant.cells)
+        dones = illegal | won | tie
+
+        rewards = np.zeros(self.num_envs, dtype=np.float32)
+        rewards[won] = np.where(x_moves[won], -1, 1)
+        rewards[illegal] = ILLEGAL_MOVE_REWARD
+        self.turn ^= 1
+
+        obs = self.obs.copy()
+        infos = [{} for _ in range(self.num_envs)]
+        finished = np.flatnonzero(dones)
+        for i in finished:
+            infos[i]["terminal_observation"] = obs[i].copy()
+        if len(finished):
+            self.x[finished] = 0
+            self.o[finished] = 0
+            self.turn[finished] = 0
+            self.filled[finished] = 0
+            self.board[finished] = 0
+            obs[finished] = 0
+        return obs, rewards, dones, infos
+
+    def action_masks(self, index):
+        return self.obs[index] == 0
+
+    def close(self):
+        pass
+
+    def seed(self, seed=None):
+        # The game itself is deterministic; nothing to seed
+        return [seed] * self.num_envs
+
+    def _indices(self, indices):
+        if indices is None:
+            return range(self.num_envs)
+        if isinstance(indices, int):
+            return [indices]
+        return indices
+
+    def get_attr(self, attr_name, indices=None):
+        return [getattr(self, attr_name) for _ in self._indices(indices)]
+
+    def set_attr(self, attr_name, value, indices=None):
+        setattr(self, attr_name, value)
+
+    def env_method(self, method_name, *method_args, indices=None, **method_kwargs):
+        # Methods are called once per env with that env's index first
+        method = getattr(self, method_name)
+        return [method(i, *method_args, **method_kwargs) for i in self._indices(indices)]
+
+    def env_is_wrapped(self, wrapper_class, indices=None):
+        return [False for _ in self._indices(indices)]
+
+
+def shard_worker(remote, num_envs, variant):
+    # Runs in a worker process: steps one TicTacToeVecEnv shard. Infos are
+    # sent back as the terminal observations only, in the order of dones.
+    env = TicTacToeVecEnv(num_envs, variant)
+    try:
+        while True:
+            command, actions = remote.recv()
+            if command == "step":
+                env.step_async(actions)
+                obs, rewards, dones, infos = env.step_wait()
+                terminal = [infos[i]["terminal_observation"] for i in np.flatnonzero(dones)]
+                remote.send((obs, rewards, dones, terminal))
+            elif command == "reset":
+                remote.send(env.reset())
+            elif command == "close":
+                break
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        remote.close()
+
+
+# TicTacToeVecEnv split into shards of num_envs / workers boards, each
+# stepped by its own process, so one step costs a single pipe round trip
+# per worker, not per board. The last observations are kept here: action
+# masks are read from them without asking the workers.
+class ShardedTicTacToeVecEnv(TicTacToeVecEnv):
+    def __init__(self, workers, num_envs=64, variant=CLASSIC):
+        cells = variant.cells
+        observation_space = spaces.Box(low=0, high=2, shape=(cells,), dtype=np.int32)
+        VecEnv.__init__(self, num_envs, observation_space, spaces.Discrete(cells))
+        self.variant = variant
+        self.obs = np.zeros((num_envs, cells), dtype=np.int32)
+        self.sizes = [len(shard) for shard in np.array_split(np.arange(num_envs), workers)]
+        self.bounds = np.cumsum(self.sizes)[:-1]
+        # forkserver, like SubprocVecEnv: the workers do not inherit torch
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        self.remotes, self.processes = [], []
+        for size in self.sizes:
+            remote, worker_remote = context.Pipe()
+            process = context.Process(target=shard_worker, args=(worker_remote, size, variant), daemon=True)
+            process.start()
+            worker_remote.close()
+            self.remotes.append(remote)
+            self.processes.append(process)
+        self.closed = False
+
+    def reset(self):
+        for remote in self.remotes:
+            remote.send(("reset", None))
+        self.obs = np.concatenate([remote.recv() for remote in self.remotes])
+        return self.obs.copy()
+
+    def step_async(self, actions):
+        actions = np.asarray(actions, dtype=np.int64).reshape(self.num_envs)
+        for remote, shard in zip(self.remotes, np.split(actions, self.bounds)):
+            remote.send(("step", shard))
+
+    def step_wait(self):
+        results = [remote.recv() for remote in self.remotes]
+        obs = np.concatenate([result[0] for result in results])
+        rewards = np.concatenate([result[1] for result in results])
+        dones = np.concatenate([result[2] for result in results])
+        infos = [{} for _ in range(self.num_envs)]
+        terminal = [board for result in results for board in result[3]]
+        for i, board in zip(np.flatnonzero(dones), terminal):
+            infos[i]["terminal_observation"] = board
+        self.obs = obs
+        return obs.copy(), rewards, dones, infos
+
+    def close(self):
+        if self.closed:
+            return
+        for remote in self.remotes:
+            remote.send(("close", None))
+        for process in self.processes:
+            process.join()
+        self.closed = True
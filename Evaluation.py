@@ -0,0 +1,195 @@
+import argparse
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+
+import Book
+from Engine import CELLS, FULL, WINNING
+from Inference import MODEL_PATH, POLICY_PATH, NumpyPolicy, zip_path
+
+RESULTS_PATH = "evaluation_results.jsonl"
+WIN_TABLE = np.array(WINNING, dtype=bool)
+# Games played per task sent to a worker process: enough to batch the
+# policy's forward passes, small enough to spread over the workers
+CHUNK = 500
+
+
+def random_moves(obs, rng):
+    # One uniformly random free cell per board
+    return np.argmax(np.where(obs == 0, rng.random(obs.shape), -1), axis=1)
+
+
+class RandomAgent:
+    def __init__(self, seed=None):
+        self.rng = np.random.default_rng(seed)
+
+    def predict(self, obs):
+        return random_moves(obs, self.rng)
+
+
+# The trained network, unmasked unless asked otherwise: an occupied cell
+# it picks counts as an illegal move and loses the game, as in TicTacToeEnv
+class PolicyAgent:
+    def __init__(self, policy, masked=False):
+        self.policy = policy
+        self.masked = masked
+
+    def predict(self, obs):
+        return self.policy.predict(obs, None if self.masked else np.ones(obs.shape, dtype=bool))
+
+
+@lru_cache(maxsize=None)
+def load_agent(spec, masked=False):
+    # "random", "minimax" (the solved book: perfect play), "ppo" for the
+    # saved model, or "ppo:<path>" for any checkpoint .zip or exported .npz
+    name, _, path = spec.partition(":")
+    if name == "random":
+        return RandomAgent()
+    if name == "minimax":
+        return Book.load()
+    if name == "ppo":
+        if not path:
+            path = MODEL_PATH if os.path.exists(zip_path(MODEL_PATH)) else POLICY_PATH
+        if path.endswith(".npz"):
+            return PolicyAgent(NumpyPolicy.load(path), masked)
+        return PolicyAgent(NumpyPolicy.from_model(path), masked)
+    raise ValueError(f"unknown agent {spec!r} (random, minimax, ppo or ppo:<path>)")
+
+
+def task_agent(spec, masked, seed):
+    # The random agent is built for each task from the task's seed, so a
+    # tournament with the same seed replays exactly; the others are cached
+    if spec == "random":
+        return RandomAgent(seed)
+    return load_agent(spec, masked)
+
+
+def play_games(x_spec, o_spec, games, openings=0, seed=0, masked=False):
+    # Plays all the games of one task in lockstep: every ply, the side to
+    # move answers for all unfinished boards in one predict call. The first
+    # `openings` plies are random, so deterministic agents meet in varied
+    # positions.
+    opening_seed, x_seed, o_seed = np.random.SeedSequence(seed).spawn(3)
+    agents = (task_agent(x_spec, masked, x_seed), task_agent(o_spec, masked, o_seed))
+    rng = np.random.default_rng(opening_seed)
+    obs = np.zeros((games, CELLS), dtype=np.int32)
+    masks = np.zeros((2, games), dtype=np.int64)
+    winner = np.full(games, -1)  # 0 X, 1 O, 2 tie
+    moves, illegal, seconds = [0, 0], [0, 0], [0.0, 0.0]
+    for ply in range(CELLS):
+        active = np.flatnonzero(winner < 0)
+        if not len(active):
+            break
+        side = ply % 2
+        if ply < openings:
+            actions = random_moves(obs[active], rng)
+        else:
+            start = time.perf_counter()
+            actions = np.asarray(agents[side].predict(obs[active]), dtype=np.int64)
+            seconds[side] += time.perf_counter() - start
+            moves[side] += len(active)
+            wrong = obs[active, actions] != 0
+            illegal[side] += int(wrong.sum())
+            winner[active[wrong]] = 1 - side
+            active, actions = active[~wrong], actions[~wrong]
+        obs[active, actions] = side + 1
+        masks[side, active] |= np.left_shift(1, actions)
+        won = WIN_TABLE[masks[side, active]]
+        winner[active[won]] = side
+        full = (masks[0, active] | masks[1, active]) == FULL
+        winner[active[~won & full]] = 2
+    outcomes = np.bincount(winner, minlength=3)
+    return {"x_wins": int(outcomes[0]), "o_wins": int(outcomes[1]), "ties": int(outcomes[2]),
+            "moves": moves, "illegal": illegal, "seconds": seconds}
+
+
+def tournament(specs, games=1000, workers=None, openings=2, seed=0, masked=False):
+    # Round robin: every pair of agents plays `games` games, each agent
+    # taking X in half of them, in chunks spread over worker processes
+    # (workers=0 plays everything in this process)
+    tasks = []
+    for a, b in itertools.combinations(specs, 2):
+        for a_is_x in (True, False):
+            remaining = games // 2 if a_is_x else games - games // 2
+            while remaining > 0:
+                count = min(CHUNK, remaining)
+                x, o = (a, b) if a_is_x else (b, a)
+                tasks.append(((a, b), a_is_x, (x, o, count, openings, seed + len(tasks), masked)))
+                remaining -= count
+    start = time.perf_counter()
+    if workers == 0:
+        outcomes = [play_games(*args) for _, _, args in tasks]
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            outcomes = list(pool.map(play_games, *zip(*(args for _, _, args in tasks))))
+    elapsed = time.perf_counter() - start
+
+    standings = {}
+    for (pairing, a_is_x, _), outcome in zip(tasks, outcomes):
+        entry = standings.setdefault(pairing, {"games": 0, "wins": 0, "draws": 0, "losses": 0,
+                                               "moves": [0, 0], "illegal": [0, 0], "seconds": [0.0, 0.0]})
+        # Index 0 is the first agent of the pairing, whichever side it played
+        sides = (0, 1) if a_is_x else (1, 0)
+        a_wins, b_wins = (outcome["x_wins"], outcome["o_wins"]) if a_is_x else (outcome["o_wins"], outcome["x_wins"])
+        entry["games"] += a_wins + b_wins + outcome["ties"]
+        entry["wins"] += a_wins
+        entry["losses"] += b_wins
+        entry["draws"] += outcome["ties"]
+        for agent, side in enumerate(sides):
+            for key in ("moves", "illegal", "seconds"):
+                entry[key][agent] += outcome[key][side]
+    results = []
+    for (a, b), entry in standings.items():
+        games_played = max(entry["games"], 1)
+        results.append({
+            "agents": [a, b],
+            "games": entry["games"],
+            "win_rate": entry["wins"] / games_played,
+            "draw_rate": entry["draws"] / games_played,
+            "loss_rate": entry["losses"] / games_played,
+            "illegal_rate": [illegal / max(moves, 1) for illegal, moves in zip(entry["illegal"], entry["moves"])],
+            "moves_per_second": [round(moves / seconds) if seconds else 0
+                                 for moves, seconds in zip(entry["moves"], entry["seconds"])],
+        })
+    total = sum(result["games"] for result in results)
+    return results, {"games": total, "seconds": round(elapsed, 3), "games_per_second": round(total / elapsed, 1)}
+
+
+def report(results, summary):
+    for result in results:
+        a, b = result["agents"]
+        print(f"{a} vs {b}: {result['games']} games, {a} wins {result['win_rate']:.1%}, "
+              f"draws {result['draw_rate']:.1%}, loses {result['loss_rate']:.1%}")
+        for agent, illegal, speed in zip(result["agents"], result["illegal_rate"], result["moves_per_second"]):
+            print(f"  {agent}: {illegal:.2%} illegal moves, {speed} moves/s")
+    print(f"{summary['games']} games in {summary['seconds']} s ({summary['games_per_second']}/s)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Play Tic Tac Toe agents against each other")
+    parser.add_argument("agents", nargs="*", default=["ppo", "minimax", "random"],
+                        help="random, minimax, ppo or ppo:<checkpoint .zip or policy .npz>")
+    parser.add_argument("--games", type=int, default=2000, help="games per pair of agents")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="worker processes (0: play in this process)")
+    parser.add_argument("--openings", type=int, default=2,
+                        help="random plies before the agents take over")
+    parser.add_argument("--seed", type=int, default=0, help="seeds the random openings and the random agent")
+    parser.add_argument("--masked", action="store_true",
+                        help="never let the policy pick an occupied cell")
+    parser.add_argument("--output", default=RESULTS_PATH, help="JSON lines file the run is appended to")
+    args = parser.parse_args()
+    if len(args.agents) < 2:
+        parser.error("give at least two agents")
+
+    results, summary = tournament(args.agents, args.games, args.workers, args.openings, args.seed, args.masked)
+    report(results, summary)
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(json.dumps({"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "openings": args.openings,
+                                "masked": args.masked, "results": results, **summary}) + "\n")
@@ -0,0 +1,141 @@
+import io
+import json
+import pickle
+import sys
+import zipfile
+from collections import OrderedDict
+
+import numpy as np
+
+MODEL_PATH = "tictactoe_model"
+POLICY_PATH = "tictactoe_policy.npz"
+
+STORAGE_DTYPES = {
+    "FloatStorage": np.float32,
+    "DoubleStorage": np.float64,
+    "HalfStorage": np.float16,
+    "LongStorage": np.int64,
+    "IntStorage": np.int32,
+}
+ACTIVATIONS = {
+    "tanh": np.tanh,
+    "relu": lambda h: np.maximum(h, 0),
+}
+
+
+def zip_path(path):
+    return path if path.endswith(".zip") else path + ".zip"
+
+
+# Reads the tensors of a torch state dict (policy.pth) straight into NumPy
+# arrays, so exporting the weights does not need torch either
+class StateDictUnpickler(pickle.Unpickler):
+    def __init__(self, archive, prefix):
+        super().__init__(io.BytesIO(archive.read(f"{prefix}/data.pkl")))
+        self.archive = archive
+        self.prefix = prefix
+
+    def find_class(self, module, name):
+        if module == "collections" and name == "OrderedDict":
+            return OrderedDict
+        if module == "torch._utils" and name == "_rebuild_tensor_v2":
+            return rebuild_tensor
+        if module == "torch" and name in STORAGE_DTYPES:
+            return STORAGE_DTYPES[name]
+        raise pickle.UnpicklingError(f"Unexpected object in state dict: {module}.{name}")
+
+    def persistent_load(self, pid):
+        _, dtype, key, _location, numel = pid
+        data = self.archive.read(f"{self.prefix}/data/{key}")
+        return np.frombuffer(data, dtype=np.dtype(dtype).newbyteorder("<"), count=numel)
+
+
+def rebuild_tensor(storage, offset, size, stride, *args):
+    itemsize = storage.itemsize
+    return np.lib.stride_tricks.as_strided(storage[offset:], shape=size,
+                                           strides=[s * itemsize for s in stride]).copy()
+
+
+def read_state_dict(path=MODEL_PATH, name="policy.pth"):
+    with zipfile.ZipFile(zip_path(path)) as model_archive:
+        with zipfile.ZipFile(io.BytesIO(model_archive.read(name))) as archive:
+            prefix = archive.namelist()[0].split("/")[0]
+            return StateDictUnpickler(archive, prefix).load()
+
+
+def read_activation(path=MODEL_PATH):
+    with zipfile.ZipFile(zip_path(path)) as archive:
+        policy_kwargs = json.loads(archive.read("data")).get("policy_kwargs", {})
+    return "relu" if "ReLU" in json.dumps(policy_kwargs) else "tanh"
+
+
+def actor_arrays(model_path=MODEL_PATH):
+    # Keeps only the actor: the policy_net MLP and the action head, as
+    # w0, b0, w1, ... arrays
+    state = read_state_dict(model_path)
+    hidden = sorted({int(key.split(".")[2]) for key in state
+                     if key.startswith("mlp_extractor.policy_net.")})
+    arrays = {}
+    for i, index in enumerate(hidden):
+        arrays[f"w{i}"] = state[f"mlp_extractor.policy_net.{index}.weight"]
+        arrays[f"b{i}"] = state[f"mlp_extractor.policy_net.{index}.bias"]
+    arrays[f"w{len(hidden)}"] = state["action_net.weight"]
+    arrays[f"b{len(hidden)}"] = state["action_net.bias"]
+    return arrays
+
+
+def export_policy(model_path=MODEL_PATH, policy_path=POLICY_PATH):
+    arrays = actor_arrays(model_path)
+    np.savez(policy_path, activation=read_activation(model_path), **arrays)
+    print(f"Exported {len(arrays) // 2} layers from {zip_path(model_path)} to {policy_path}")
+
+
+# Pure NumPy forward pass of the exported actor network
+class NumpyPolicy:
+    def __init__(self, weights, biases, activation="tanh"):
+        self.weights = [w.T.astype(np.float32) for w in weights]
+        self.biases = [b.astype(np.float32) for b in biases]
+        self.activation = ACTIVATIONS[activation]
+
+    @classmethod
+    def load(cls, path=POLICY_PATH):
+        with np.load(path) as data:
+            layers = (len(data.files) - 1) // 2
+            return cls([data[f"w{i}"] for i in range(layers)],
+                       [data[f"b{i}"] for i in range(layers)],
+                       str(data["activation"]))
+
+    @classmethod
+    def from_model(cls, path=MODEL_PATH):
+        # Straight from a PPO checkpoint, without exporting it first
+        arrays = actor_arrays(path)
+        layers = len(arrays) // 2
+        return cls([arrays[f"w{i}"] for i in range(layers)],
+                   [arrays[f"b{i}"] for i in range(layers)],
+                   read_activation(path))
+
+    def logits(self, obs):
+        h = np.asarray(obs, dtype=np.float32)
+        for w, b in zip(self.weights[:-1], self.biases[:-1]):
+            h = self.activation(h @ w + b)
+        return h @ self.weights[-1] + self.biases[-1]
+
+    def predict(self, obs, mask=None):
+        # Accepts one board or a batch; occupied cells are never chosen
+        obs = np.asarray(obs)
+        if mask is None:
+            mask = legal_mask(obs)
+        logits = np.where(mask, self.logits(obs), -np.inf)
+        if obs.ndim == 1:
+            return int(np.argmax(logits))
+        return np.argmax(logits, axis=1)
+
+
+def legal_mask(obs):
+    return np.asarray(obs) == 0
+
+
+if __name__ == "__main__":
+    model_path = sys.argv[1] if len(sys.argv) > 1 else MODEL_PATH
+    policy_path = sys.argv[2] if len(sys.argv) > 2 else POLICY_PATH
+    export_policy(model_path, policy_path)
@@ -0,0 +1,235 @@
+import argparse
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from collections import Counter
+from Engine import CELLS, Position
+
+# Append-only log of finished games. After an 8-byte header, every game is
+# one fixed-size record, so a journal can be mapped and indexed directly:
+#   time (f64) | room (u32) | result (u8) | length (u8) | flags (u8) | moves (9 x u8)
+JOURNAL_PATH = "games.journal"
+MAGIC = b"TTTJ"
+VERSION = 1
+HEADER = struct.Struct("<4sHH")
+RECORD = struct.Struct("<dIBBB9s")
+NO_CELL = 0xFF
+
+RESULT_X, RESULT_O, RESULT_TIE, RESULT_ABANDONED = range(4)
+RESULT_NAMES = ("X wins", "O wins", "tie", "abandoned")
+FLAG_AI = 1
+
+# Records are buffered in memory and written by a background thread at most
+# every FLUSH_INTERVAL seconds, or sooner once FLUSH_BYTES are pending
+FLUSH_INTERVAL = 1.0
+FLUSH_BYTES = 64 * 1024
+
+
+def result_code(winner):
+    # Engine.winner_of result ("X", "O", "TIE" or None) to a record code
+    return {"X": RESULT_X, "O": RESULT_O, "TIE": RESULT_TIE}.get(winner, RESULT_ABANDONED)
+
+
+def worker_path(path, worker_id):
+    # games.journal -> games.2.journal, one file per server process
+    root, ext = os.path.splitext(path)
+    return f"{root}.{worker_id}{ext}"
+
+
+def pack(room_id, moves, result, flags=0, when=None):
+    cells = bytes(moves) + bytes([NO_CELL]) * (CELLS - len(moves))
+    return RECORD.pack(time.time() if when is None else when, room_id, result, len(moves), flags, cells)
+
+
+class JournalWriter:
+    def __init__(self, path=JOURNAL_PATH, flush_interval=FLUSH_INTERVAL, flush_bytes=FLUSH_BYTES):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.buffer = bytearray()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(HEADER.pack(MAGIC, VERSION, RECORD.size))
+            self.file.flush()
+        self.thread = threading.Thread(target=self.run, name="journal", daemon=True)
+        self.thread.start()
+
+    def record(self, room_id, moves, result, flags=0):
+        # Hot path: packs 24 bytes into the buffer, no I/O
+        data = pack(room_id, moves, result, flags)
+        with self.lock:
+            self.buffer += data
+            full = len(self.buffer) >= self.flush_bytes
+        if full:
+            self.wakeup.set()
+
+    def flush(self):
+        with self.lock:
+            data, self.buffer = self.buffer, bytearray()
+        if data:
+            self.file.write(data)
+            self.file.flush()
+
+    def run(self):
+        while not self.closed:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+        self.thread.join()
+        self.flush()
+        self.file.close()
+
+
+def open_journal(path):
+    # Returns a read-only map of the file and the number of records in it;
+    # a record cut short by a crash at the end is ignored
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < HEADER.size:
+            raise ValueError(f"{path} is not a game journal")
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, record_size = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+        data.close()
+        raise ValueError(f"{path} is not a version {VERSION} game journal")
+    return data, (size - HEADER.size) // RECORD.size
+
+
+def games(path):
+    # Yields (time, room, result, flags, moves) without reading the whole file
+    data, count = open_journal(path)
+    with data:
+        view = memoryview(data)[HEADER.size:HEADER.size + count * RECORD.size]
+        try:
+            for when, room, result, length, flags, cells in RECORD.iter_unpack(view):
+                yield when, room, result, flags, tuple(cells[:length])
+        finally:
+            view.release()
+
+
+def game(path, index):
+    data, count = open_journal(path)
+    with data:
+        if not -count <= index < count:
+            raise IndexError(f"{path} holds {count} games")
+        when, room, result, length, flags, cells = RECORD.unpack_from(data, HEADER.size + (index % count) * RECORD.size)
+    return when, room, result, flags, tuple(cells[:length])
+
+
+def load(paths):
+    # Every record of the given journals as one NumPy structured array
+    import numpy as np
+    dtype = np.dtype([("time", "<f8"), ("room", "<u4"), ("result", "u1"),
+                      ("length", "u1"), ("flags", "u1"), ("moves", "u1", (CELLS,))])
+    arrays = []
+    for path in paths:
+        data, count = open_journal(path)
+        with data:
+            view = np.frombuffer(data, dtype, count, HEADER.size)
+            arrays.append(view.copy())
+            del view  # the map cannot close while NumPy still points into it
+    return np.concatenate(arrays) if arrays else np.zeros(0, dtype)
+
+
+def statistics(records, top=10):
+    import numpy as np
+    finished = records[records["result"] != RESULT_ABANDONED]
+    outcomes = np.bincount(records["result"], minlength=len(RESULT_NAMES))
+    lengths = np.bincount(finished["length"], minlength=CELLS + 1)
+    openings = {}
+    for cell in range(CELLS):
+        games = finished[finished["moves"][:, 0] == cell]
+        if len(games):
+            openings[cell] = np.bincount(games["result"], minlength=3)[:3]
+    pairs = Counter(map(tuple, finished["moves"][finished["length"] >= 2][:, :2].tolist()))
+    return {
+        "games": len(records),
+        "outcomes": dict(zip(RESULT_NAMES, outcomes.tolist())),
+        "lengths": {length: int(n) for length, n in enumerate(lengths) if n},
+        "first_moves": {cell: counts.tolist() for cell, counts in openings.items()},
+        "openings": pairs.most_common(top),
+    }
+
+
+def training_pairs(records):
+    # (observation, action) for every move of the side that went on to win,
+    # in TicTacToeEnv's observation layout, for pretraining the agent on
+    # real games. Games against the server AI are left out: the records do
+    # not say which side it played, and its moves are not human play.
+    import numpy as np
+    observations, actions = [], []
+    human = (records["flags"] & FLAG_AI) == 0
+    for record in records[human & (records["result"] <= RESULT_O)]:
+        winner = int(record["result"])
+        board = Position()
+        for ply, cell in enumerate(record["moves"][:record["length"]]):
+            if ply % 2 == winner:
+                observations.append(board.codes())
+                actions.append(int(cell))
+            board.play(int(cell))
+    return (np.array(observations, dtype=np.int32).reshape(-1, CELLS),
+            np.array(actions, dtype=np.int64))
+
+
+def print_game(record):
+    when, room, result, flags, moves = record
+    board = Position()
+    print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(when))}, room {room}"
+          f"{' (AI)' if flags & FLAG_AI else ''}: {RESULT_NAMES[result]} in {len(moves)} moves")
+    for cell in moves:
+        board.play(cell)
+        print()
+        for row in range(3):
+            print(" " + " | ".join(board.cell(3 * row + col) for col in range(3)))
+
+
+def print_statistics(stats):
+    print(f"{stats['games']} games: " + ", ".join(f"{n} {name}" for name, n in stats["outcomes"].items()))
+    print("Length of finished games: " + ", ".join(f"{n} x {length}" for length, n in stats["lengths"].items()))
+    print("First move      X wins  O wins   ties")
+    for cell, (x, o, tie) in stats["first_moves"].items():
+        total = x + o + tie
+        print(f"  cell {cell}   {x / total:8.1%} {o / total:7.1%} {tie / total:7.1%}   ({total} games)")
+    print("Most played openings: " + ", ".join(f"{a}-{b} ({n})" for (a, b), n in stats["openings"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay and analyse game journals")
+    parser.add_argument("paths", nargs="*", default=[JOURNAL_PATH], help="journal files")
+    parser.add_argument("--game", type=int, help="replay game number GAME of the first journal")
+    parser.add_argument("--csv", help="write one row per game to this CSV file")
+    parser.add_argument("--pairs", help="save winning-side (observation, action) pairs to this .npz")
+    args = parser.parse_args()
+    missing = [path for path in args.paths if not os.path.exists(path)]
+    if missing:
+        parser.error(f"no journal at {', '.join(missing)}")
+
+    if args.game is not None:
+        print_game(game(args.paths[0], args.game))
+        sys.exit()
+
+    records = load(args.paths)
+    print_statistics(statistics(records))
+    if args.csv:
+        import numpy as np
+        rows = np.column_stack([records["time"], records["room"], records["result"], records["length"],
+                                records["flags"], records["moves"]])
+        header = "time,room,result,length,flags," + ",".join(f"move{i}" for i in range(CELLS))
+        np.savetxt(args.csv, rows, fmt=["%.3f"] + ["%d"] * (rows.shape[1] - 1), delimiter=",",
+                   header=header, comments="")
+        print(f"Wrote {len(records)} games to {args.csv}")
+    if args.pairs:
+        import numpy as np
+        observations, actions = training_pairs(records)
+        np.savez_compressed(args.pairs, observations=observations, actions=actions)
+        print(f"Saved {len(actions)} moves to {args.pairs}")
@@ -0,0 +1,79 @@
+import asyncio
+import time
+from collections import deque
+
+SAMPLE_WINDOW = 1024
+
+
+# Lobby numbers: how many players wait right now and how long pairing took
+class MatchmakingStats:
+    def __init__(self, window=SAMPLE_WINDOW):
+        self.queue_depth = 0
+        self.matches = 0
+        self.samples = deque(maxlen=window)
+
+    def record_match(self, *wait_times):
+        self.matches += 1
+        self.samples.extend(wait_times)
+
+    def snapshot(self):
+        ordered = sorted(self.samples)
+        def percentile(p):
+            if not ordered:
+                return 0.0
+            return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+        return {
+            "queue_depth": self.queue_depth,
+            "matches": self.matches,
+            "time_to_match_p50_ms": percentile(0.50) * 1000,
+            "time_to_match_p95_ms": percentile(0.95) * 1000,
+            "time_to_match_max_ms": (ordered[-1] if ordered else 0.0) * 1000,
+        }
+
+    def report(self):
+        s = self.snapshot()
+        return (f"Lobby: {s['queue_depth']} waiting, {s['matches']} matches, "
+                f"time to match p50 {s['time_to_match_p50_ms']:.2f} ms, "
+                f"p95 {s['time_to_match_p95_ms']:.2f} ms, max {s['time_to_match_max_ms']:.2f} ms")
+
+
+class Ticket:
+    def __init__(self, player, future):
+        self.player = player
+        self.future = future
+        self.enqueued_at = time.perf_counter()
+
+
+# Pairs waiting players as soon as a second one arrives. Each player gets a
+# future that resolves to (room, player_id) once create_room has seated them.
+class Matchmaker:
+    def __init__(self, create_room):
+        self.create_room = create_room
+        self.queue = deque()
+        self.stats = MatchmakingStats()
+
+    def enqueue(self, player):
+        ticket = Ticket(player, asyncio.get_running_loop().create_future())
+        while self.queue:
+            other = self.queue.popleft()
+            if other.future.done():
+                continue
+            self.stats.queue_depth -= 1
+            self.pair(other, ticket)
+            return ticket
+        self.queue.append(ticket)
+        self.stats.queue_depth += 1
+        return ticket
+
+    def pair(self, first, second):
+        now = time.perf_counter()
+        room = self.create_room(first.player, second.player)
+        self.stats.record_match(now - first.enqueued_at, now - second.enqueued_at)
+        first.future.set_result((room, 0))
+        second.future.set_result((room, 1))
+
+    def cancel(self, ticket):
+        # Left in the deque and skipped on the next enqueue
+        if not ticket.future.done():
+            ticket.future.cancel()
+            self.stats.queue_depth -= 1
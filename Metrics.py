@@ -0,0 +1,226 @@
+import bisect
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def get(self):
+        return self.value
+
+    def samples(self):
+        return [(self.name, self.get())]
+
+
+# A gauge either follows inc/dec/set calls or, given a function, reads its
+# value from the server state when scraped
+class Gauge(Counter):
+    def __init__(self, name, help, function=None):
+        super().__init__(name, help)
+        self.function = function
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        return self.function() if self.function else self.value
+
+
+# Fixed buckets, so observing is a bisect and a few additions whatever the
+# number of samples; quantiles are read back from the bucket counts
+class Histogram:
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th sample
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def samples(self):
+        samples = []
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            samples.append((f'{self.name}_bucket{{le="{bound}"}}', seen))
+        samples.append((f'{self.name}_bucket{{le="+Inf"}}', self.count))
+        samples.append((f"{self.name}_sum", self.sum))
+        samples.append((f"{self.name}_count", self.count))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.last_report = (time.perf_counter(), {})
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help):
+        return self.register(Counter(name, help))
+
+    def gauge(self, name, help, function=None):
+        return self.register(Gauge(name, help, function))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, buckets))
+
+    def render(self):
+        # Prometheus text format
+        lines = []
+        for metric in self.metrics.values():
+            kind = type(metric).__name__.lower()
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {kind}")
+            lines.extend(f"{name} {value}" for name, value in metric.samples())
+        return "\n".join(lines) + "\n"
+
+    def report(self):
+        # One line for the periodic dump: gauges as they are, counters as a
+        # rate since the previous report, histograms as p50/p99
+        now = time.perf_counter()
+        since, previous = self.last_report
+        elapsed = max(now - since, 1e-9)
+        parts = []
+        totals = {}
+        for metric in self.metrics.values():
+            if isinstance(metric, Histogram):
+                parts.append(f"{metric.name} p50 {metric.quantile(0.5) * 1000:g} ms "
+                             f"p99 {metric.quantile(0.99) * 1000:g} ms")
+            elif isinstance(metric, Gauge):
+                parts.append(f"{metric.name} {metric.get()}")
+            else:
+                totals[metric.name] = metric.value
+                rate = (metric.value - previous.get(metric.name, 0)) / elapsed
+                parts.append(f"{metric.name} {metric.value} ({rate:.1f}/s)")
+        self.last_report = (now, totals)
+        return ", ".join(parts)
+
+
+# What both servers measure
+class ServerMetrics(Registry):
+    def __init__(self):
+        super().__init__()
+        self.connections = self.gauge("active_connections", "Connected players, waiting or in a game")
+        self.games = self.gauge("active_games", "Games in progress")
+        self.moves = self.counter("moves_total", "Moves played")
+        self.send_failures = self.counter("send_failures_total", "Writes to a player that failed")
+        self.evictions = self.counter("evictions_total", "Players cut off for not reading their updates")
+        self.message_latency = self.histogram("message_handling_seconds",
+                                              "Time spent handling one client message")
+        self.spectators = self.gauge("active_spectators", "Connected spectators")
+        self.spectators_dropped = self.counter("spectators_dropped_total",
+                                               "Spectators cut off for not reading fast enough")
+
+
+# threading.Lock that records how long each blocking acquire waited. Works
+# as the lock of a threading.Condition too.
+class TimedLock:
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.lock = threading.Lock()
+
+    def acquire(self, blocking=True, timeout=-1):
+        if not blocking:
+            return self.lock.acquire(False)
+        start = time.perf_counter()
+        acquired = self.lock.acquire(True, timeout)
+        self.histogram.observe(time.perf_counter() - start)
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    def locked(self):
+        return self.lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def serve(registry, host, port):
+    # Scrape endpoint on a daemon thread: GET /metrics (any path, really)
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+def dump_periodically(registry, interval, log):
+    def dump():
+        while True:
+            time.sleep(interval)
+            log.info("Metrics: %s", registry.report())
+    threading.Thread(target=dump, name="metrics-dump", daemon=True).start()
+
+
+def setup_logging(level="INFO", prefix=""):
+    # Log calls only put the record on a queue; a listener thread does the
+    # formatting and the actual stdout writes, off the game threads and loop
+    records = queue.SimpleQueue()
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(logging.Formatter(prefix + "%(message)s"))
+    listener = logging.handlers.QueueListener(records, output)
+    root = logging.getLogger()
+    root.handlers[:] = [logging.handlers.QueueHandler(records)]
+    root.setLevel(level)
+    listener.start()
+    return listener
@@ -0,0 +1,51 @@
+# Message framing shared by the servers and the clients.
+# Every message is one newline-terminated record ("MOVE:4\n"), so several
+# messages coalesced into one TCP read, or one message split across reads,
+# are always rebuilt exactly.
+
+DELIMITER = b"\n"
+ENCODING = "utf-8"
+MAX_MESSAGE_SIZE = 64 * 1024
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode(message):
+    return message.encode(ENCODING) + DELIMITER
+
+
+def encode_batch(messages):
+    # One buffer for several messages, so they go out in a single sendall
+    return b"".join(message.encode(ENCODING) + DELIMITER for message in messages)
+
+
+class Decoder:
+    def __init__(self, max_message_size=MAX_MESSAGE_SIZE):
+        self.buffer = bytearray()
+        self.max_message_size = max_message_size
+
+    def feed(self, data):
+        self.buffer += data
+        messages = []
+        start = 0
+        while True:
+            end = self.buffer.find(DELIMITER, start)
+            if end == -1:
+                break
+            try:
+                message = self.buffer[start:end].decode(ENCODING).strip()
+            except UnicodeDecodeError as e:
+                # Callers drop the connection on ProtocolError; the bad
+                # record is discarded with everything before it
+                del self.buffer[:end + 1]
+                raise ProtocolError(f"Message is not valid {ENCODING}") from e
+            if message:
+                messages.append(message)
+            start = end + 1
+        if start:
+            del self.buffer[:start]
+        if len(self.buffer) > self.max_message_size:
+            raise ProtocolError(f"Message exceeds {self.max_message_size} bytes")
+        return messages
@@ -0,0 +1,129 @@
+import os
+from functools import lru_cache
+
+import pygame
+
+TEXT_CACHE_SIZE = 256
+# Scaled copies of the image assets, stored uncompressed: loading one is a
+# copy, where decoding the source JPEG and scaling it takes tens of ms
+ASSET_CACHE = ".asset_cache"
+
+
+def open_window(size, caption, headless=False):
+    # Only the display and font modules are started, not audio or joysticks.
+    # Headless runs (or SDL_VIDEODRIVER=dummy) draw to an offscreen surface,
+    # so bots, tests and benchmarks can drive the clients without a screen.
+    if headless:
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
+        os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    pygame.display.init()
+    pygame.font.init()
+    win = pygame.display.set_mode(size)
+    pygame.display.set_caption(caption)
+    return win
+
+
+@lru_cache(maxsize=None)
+def load_image(path, size=None):
+    # Raises pygame.error or OSError when the asset is missing
+    if size is None:
+        return pygame.image.load(path)
+    root = os.path.splitext(os.path.basename(path))[0]
+    cached = os.path.join(ASSET_CACHE, f"{root}_{size[0]}x{size[1]}.bmp")
+    if os.path.exists(cached) and os.path.getmtime(cached) >= os.path.getmtime(path):
+        return pygame.image.load(cached)
+    image = pygame.transform.scale(pygame.image.load(path), size)
+    try:
+        os.makedirs(ASSET_CACHE, exist_ok=True)
+        pygame.image.save(image, cached)
+    except (OSError, pygame.error):
+        pass
+    return image
+
+
+# Keeps the pygame clients from redoing work every frame: assets are scaled
+# once, text surfaces are cached by string, and only the rects that changed
+# since the last flush are pushed to the display.
+class Renderer:
+    def __init__(self, win, background, font):
+        self.win = win
+        self.background = background.convert()
+        self.font = font
+        self.scaled = {}
+        self.texts = {}
+        self.slots = {}
+        self.dirty = []
+        self.full_redraw = True
+
+    def scaled_image(self, name, image, size):
+        key = (name, size)
+        if key not in self.scaled:
+            self.scaled[key] = pygame.transform.scale(image, size).convert_alpha()
+        return self.scaled[key]
+
+    def render_text(self, message, color=(255, 255, 255)):
+        key = (message, color)
+        surface = self.texts.get(key)
+        if surface is None:
+            if len(self.texts) >= TEXT_CACHE_SIZE:
+                self.texts.clear()
+            surface = self.texts[key] = self.font.render(message, True, color)
+        return surface
+
+    def invalidate(self):
+        self.full_redraw = True
+
+    def begin_frame(self, sprites):
+        # Returns True when the whole window was repainted
+        if not self.full_redraw:
+            return False
+        self.win.blit(self.background, (0, 0))
+        for sprite in sprites:
+            self.win.blit(sprite.image, sprite.rect)
+        self.slots.clear()
+        self.dirty = [self.win.get_rect()]
+        self.full_redraw = False
+        return True
+
+    def mark(self, rect):
+        self.dirty.append(pygame.Rect(rect))
+
+    def restore(self, rect):
+        self.win.blit(self.background, rect, rect)
+        self.mark(rect)
+
+    def draw_sprite(self, sprite):
+        self.restore(sprite.rect)
+        self.win.blit(sprite.image, sprite.rect)
+
+    def show(self, name, key, rect, paint):
+        # Paints a named overlay (status line, button...) only when its key
+        # changed, clearing whatever that slot showed before
+        current = self.slots.get(name)
+        if current and current[0] == key:
+            return
+        self.hide(name)
+        paint(self.win)
+        self.mark(rect)
+        self.slots[name] = (key, rect, paint)
+
+    def show_text(self, name, message, color=(255, 255, 255), **position):
+        surface = self.render_text(message, color)
+        rect = surface.get_rect(**position)
+        self.show(name, (message, color, rect.topleft), rect,
+                  lambda win: win.blit(surface, rect))
+
+    def hide(self, name):
+        current = self.slots.pop(name, None)
+        if current:
+            rect = current[1]
+            self.restore(rect)
+            # Overlays sharing that area were wiped too; paint them back
+            for _, other_rect, paint in self.slots.values():
+                if other_rect.colliderect(rect):
+                    paint(self.win)
+
+    def flush(self):
+        if self.dirty:
+            pygame.display.update(self.dirty)
+            self.dirty = []
@@ -1,160 +1,514 @@
+import argparse
+import collections
+import logging
+import secrets
+import signal
 import socket
 import threading
 import time
+import Journal
+import Metrics
+from Engine import CLASSIC, Position, Variant
+from Matchmaking import MatchmakingStats
+from Protocol import Decoder, ProtocolError, encode, encode_batch
 
 # Server configuration
 HOST = "127.0.0.1"
 PORT = 5555
+METRICS_INTERVAL = 10
+HELLO_TIMEOUT = 0.5
+# A dropped player keeps its seat this long, waiting for RESUME:token
+RESUME_GRACE = 15
+TOKEN_BYTES = 8
+BACKLOG = 128
+# Bytes queued for a connection before it is considered stuck and evicted,
+# and how long one write to it may block; nothing else ever waits on it
+HIGH_WATER = 64 * 1024
+WRITE_TIMEOUT = 5
+log = logging.getLogger("serveur")
 clients = [None, None]
-game_state = [" "] * 9
+# Board size and win length, set by start_server; sent to each player as
+# RULES:size:win before its ID
+variant = CLASSIC
+board = Position()
 current_turn = 0
 game_active = False
-lock = threading.Lock()
+# Sequence number of the board, bumped on every move and reset. Players that
+# sent DELTA get "DELTA:seq:cell:symbol:turn" after a move instead of a full
+# STATE; full snapshots still go out on start, reset and SYNC.
+seq = 0
+delta_clients = [False, False]
+# Resume token of each seat; a seat is taken while its token is set, even if
+# its player is momentarily disconnected
+tokens = [None, None]
+away_timers = [None, None]
+# Cells played in the current game, journaled when it ends
+moves = []
+journal = None
+spectators = []
+metrics = Metrics.ServerMetrics()
+metrics.connections.function = lambda: sum(c is not None for c in clients)
+metrics.games.function = lambda: int(game_active)
+metrics.spectators.function = lambda: len(spectators)
+# Every acquire records how long it waited, so contention shows up in
+# lock_wait_seconds
+lock = Metrics.TimedLock(metrics.histogram("lock_wait_seconds", "Wait to acquire the game lock"))
+# Signalled whenever a seat is filled, so waiting players wake
+# up the moment their opponent arrives instead of polling
+lobby_stats = MatchmakingStats()
+waiting_since = None
+
+def state_message():
+    return "STATE:" + ",".join(board.cells()) + ":" + str(current_turn) + ":" + str(seq)
 
 def send_game_state(player_id):
     if clients[player_id]:
-        state_msg = "STATE:" + ",".join(game_state) + ":" + str(current_turn)
-        try:
-            clients[player_id].send(state_msg.encode())
-        except:
-            print(f"Failed to send state to Player {player_id + 1}")
+        clients[player_id].send(encode(state_message()))
 
 def broadcast_game_state():
-    for i in range(2):
-        send_game_state(i)
+    broadcast_messages([state_message()])
 
 def check_winner():
-    for i in range(0, 9, 3):
-        if game_state[i] != " " and game_state[i] == game_state[i+1] == game_state[i+2]:
-            return game_state[i]
-    for i in range(3):
-        if game_state[i] != " " and game_state[i] == game_state[i+3] == game_state[i+6]:
-            return game_state[i]
-    if game_state[0] != " " and game_state[0] == game_state[4] == game_state[8]:
-        return game_state[0]
-    if game_state[2] != " " and game_state[2] == game_state[4] == game_state[6]:
-        return game_state[2]
-    if all(cell != " " for cell in game_state):
-        return "TIE"
-    return None
+    return board.winner()
 
-def handle_client(client, player_id):
-    global current_turn, game_active
-    print(f"Thread started for Player {player_id + 1}")
-    other_id = 1 - player_id
-    symbol = "X" if player_id == 0 else "O"
+def handle_message(player_id, data):
+    global current_turn, game_active, seq
+    if data.startswith("MOVE:") and current_turn == player_id:
+        try:
+            position = int(data.split(":")[1])
+            with lock:
+                if game_active and board.is_free(position):
+                    board.play(position, player_id)
+                    moves.append(position)
+                    metrics.moves.inc()
+                    seq += 1
+                    winner = check_winner()
+                    messages = []
+                    if winner:
+                        if winner == "TIE":
+                            messages.append("RESULT:TIE")
+                        else:
+                            winning_player = 0 if winner == "X" else 1
+                            messages.append(f"RESULT:WIN:{winning_player}")
+                        game_active = False
+                        journal_game(Journal.result_code(winner))
+                    else:
+                        current_turn = 1 - player_id
+                    delta = f"DELTA:{seq}:{position}:{'XO'[player_id]}:{current_turn}"
+                    broadcast_update(messages, delta)
+        except ValueError:
+            log.warning("Invalid move format from Player %d", player_id + 1)
 
-    try:
-        while not all(clients):
-            time.sleep(0.1)
+    elif data == "RESET" and not game_active:
+        with lock:
+            if player_id == 0 and all(clients):
+                reset_game()
+                broadcast_messages(["RESET", state_message()])
+
+    elif data == "DELTA":
+        delta_clients[player_id] = True
 
+    elif data == "SYNC":
         with lock:
-            if player_id == 0 and not game_active:
-                game_active = True
-                print("Game starts!")
-                broadcast_game_state()
+            send_game_state(player_id)
 
-        while True:
+def handle_client(connection, player_id, decoder, pending):
+    # Reads the player's socket from the moment it is seated, so a player
+    # who quits or hangs up while alone in the lobby frees the seat at once
+    log.debug("Thread started for Player %d", player_id + 1)
+    quitting = False
+
+    try:
+        for data in pending:
+            handle_message(player_id, data)
+        while not quitting:
             try:
-                data = client.recv(4096).decode().strip()
-                if not data:
-                    print(f"Player {player_id + 1} disconnected.")
+                chunk = connection.client.recv(4096)
+                if not chunk:
+                    log.info("Player %d disconnected.", player_id + 1)
                     break
 
-                print(f"Received from Player {player_id + 1}: {data}")
-
-                if data.startswith("MOVE:") and current_turn == player_id:
-                    try:
-                        position = int(data.split(":")[1])
-                        with lock:
-                            if 0 <= position <= 8 and game_state[position] == " ":
-                                game_state[position] = symbol
-                                winner = check_winner()
-                                if winner:
-                                    if winner == "TIE":
-                                        broadcast_message("RESULT:TIE")
-                                    else:
-                                        winning_player = 0 if winner == "X" else 1
-                                        broadcast_message(f"RESULT:WIN:{winning_player}")
-                                    game_active = False
-                                else:
-                                    current_turn = other_id
-                                broadcast_game_state()
-                    except ValueError:
-                        print(f"Invalid move format from Player {player_id + 1}")
-
-                elif data == "RESET" and not game_active:
-                    with lock:
-                        if player_id == 0:
-                            reset_game()
-                            broadcast_message("RESET")
-                            broadcast_game_state()
+                for data in decoder.feed(chunk):
+                    if data == "QUIT":
+                        quitting = True
+                        break
+                    received = time.perf_counter()
+                    log.debug("Received from Player %d: %s", player_id + 1, data)
+                    handle_message(player_id, data)
+                    metrics.message_latency.observe(time.perf_counter() - received)
 
+            except ProtocolError as e:
+                log.warning("Protocol error with Player %d: %s", player_id + 1, e)
+                break
             except Exception as e:
-                print(f"Error with Player {player_id + 1}: {e}")
+                log.warning("Error with Player %d: %s", player_id + 1, e)
                 break
 
     finally:
+        # State changes only, under the lock; the AWAY or DISCONNECT for the
+        # other player is queued on its connection, not sent from here
         with lock:
-            if clients[player_id] == client:
+            if clients[player_id] is connection:
                 clients[player_id] = None
-                broadcast_message(f"DISCONNECT:{player_id}")
-                game_active = False
-        client.close()
-        print(f"Connection closed for Player {player_id + 1}")
+                if not quitting and tokens[1 - player_id] is not None:
+                    # Dropped mid-game: the seat stays reserved for a RESUME
+                    broadcast_message(f"AWAY:{player_id}")
+                    timer = away_timers[player_id] = threading.Timer(RESUME_GRACE, expire_seat, (player_id,))
+                    timer.daemon = True
+                    timer.start()
+                else:
+                    release_seat(player_id)
+        connection.finish()
+        log.info("Connection closed for Player %d", player_id + 1)
+
+def release_seat(player_id):
+    # Called with the lock held
+    global game_active, waiting_since
+    tokens[player_id] = None
+    delta_clients[player_id] = False
+    if not any(tokens):
+        # The lobby is empty again
+        waiting_since = None
+        lobby_stats.queue_depth = 0
+    broadcast_message(f"DISCONNECT:{player_id}")
+    if game_active:
+        journal_game(Journal.RESULT_ABANDONED)
+    game_active = False
+
+def journal_game(result):
+    # Journal records have room for the classic board only
+    if journal and moves and variant == CLASSIC:
+        journal.record(0, moves, result)
+
+def expire_seat(player_id):
+    with lock:
+        if away_timers[player_id] is threading.current_thread():
+            away_timers[player_id] = None
+            log.info("Player %d did not come back", player_id + 1)
+            release_seat(player_id)
 
 def broadcast_message(message):
+    broadcast_messages([message])
+
+def broadcast_messages(messages, exclude=None):
+    # Encode once and queue every pending message to each player as one write
+    data = encode_batch(messages)
+    for i in range(2):
+        if clients[i] and i != exclude:
+            clients[i].send(data)
+    fan_out(lambda mode: data)
+
+def broadcast_update(messages, delta):
+    # Each encoding is built at most once, whatever the number of receivers
+    encoded = {}
+    def encoding(mode):
+        if mode not in encoded:
+            encoded[mode] = encode_batch(messages + [delta if mode else state_message()])
+        return encoded[mode]
     for i in range(2):
         if clients[i]:
+            clients[i].send(encoding(delta_clients[i]))
+    fan_out(encoding)
+
+def fan_out(encoding):
+    # Called with the lock held. A spectator that does not keep up is
+    # evicted by its connection and only needs forgetting here.
+    for spectator in list(spectators):
+        if not spectator.send(encoding(spectator.delta)):
+            remove_spectator(spectator)
+
+def remove_spectator(spectator):
+    if spectator in spectators:
+        spectators.remove(spectator)
+        spectator.close()
+
+# The sending side of a socket. Game threads only append to its queue, under
+# the lock or not, and never block; a sender thread of its own does the
+# writes, coalescing whatever piled up meanwhile into one sendall. A peer
+# that lets more than HIGH_WATER bytes pile up, or whose write has been
+# stuck for WRITE_TIMEOUT, is evicted: its socket is shut down, which also
+# ends the thread reading from it.
+class Connection:
+    def __init__(self, client, name, evictions):
+        self.client = client
+        self.name = name
+        self.evictions = evictions
+        self.delta = False
+        self.chunks = collections.deque()
+        self.size = 0
+        self.writing_since = None
+        self.closed = False
+        self.finished = False
+        self.ready = threading.Condition(threading.Lock())
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def send(self, data):
+        # Returns False once the connection is closed
+        with self.ready:
+            if self.closed:
+                return False
+            stuck = self.writing_since is not None and time.monotonic() - self.writing_since > WRITE_TIMEOUT
+            if not stuck and self.size + len(data) <= HIGH_WATER:
+                self.chunks.append(data)
+                self.size += len(data)
+                self.ready.notify()
+                return True
+        log.warning("Evicting %s: %s", self.name, "write timed out" if stuck else "not reading")
+        self.evictions.inc()
+        self.close()
+        return False
+
+    def run(self):
+        while True:
+            with self.ready:
+                self.writing_since = None
+                self.ready.wait_for(lambda: self.chunks or self.finished)
+                if not self.chunks:
+                    break
+                data = b"".join(self.chunks)
+                self.chunks.clear()
+                self.size = 0
+                self.writing_since = time.monotonic()
             try:
-                clients[i].send(message.encode())
-            except:
-                print(f"Failed to send message to Player {i + 1}")
+                self.client.sendall(data)
+            except OSError:
+                metrics.send_failures.inc()
+                self.close()
+        self.client.close()
+
+    def close(self):
+        # Drops what is queued and shuts the socket down, waking up both the
+        # sender and the reader blocked in recv
+        with self.ready:
+            self.closed = True
+            self.chunks.clear()
+            self.size = 0
+        try:
+            self.client.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def finish(self):
+        # Called by the reader when it is done: what is still queued goes
+        # out, within WRITE_TIMEOUT, then the sender closes the socket
+        self.client.settimeout(WRITE_TIMEOUT)
+        with self.ready:
+            self.finished = True
+            self.ready.notify()
+
+def watch(client, addr, decoder, pending):
+    # Spectators may send DELTA, SYNC and QUIT; anything else is ignored
+    spectator = Connection(client, "a spectator", metrics.spectators_dropped)
+    spectator.delta = "DELTA" in pending
+    with lock:
+        spectators.append(spectator)
+        spectator.send(encode_batch(["SPECTATING:0", variant.rules_message(), state_message()]))
+    log.info("Spectator connected from %s (%d watching)", addr, len(spectators))
+    try:
+        while True:
+            chunk = client.recv(4096)
+            if not chunk:
+                break
+            messages = decoder.feed(chunk)
+            if "QUIT" in messages:
+                break
+            for data in messages:
+                if data == "DELTA":
+                    spectator.delta = True
+                elif data == "SYNC":
+                    with lock:
+                        spectator.send(encode(state_message()))
+    except (OSError, ProtocolError):
+        pass
+    finally:
+        with lock:
+            remove_spectator(spectator)
+        spectator.finish()
 
 def reset_game():
-    global game_state, current_turn, game_active
-    game_state = [" "] * 9
+    global board, current_turn, game_active, seq
+    board = Position(variant=variant)
+    moves.clear()
+    seq += 1
     current_turn = 0
     game_active = True
-    print("Game reset")
+    log.info("Game reset")
+
+def seat_player(connection):
+    global waiting_since
+    with lock:
+        for i in range(2):
+            if tokens[i] is None:
+                clients[i] = connection
+                connection.name = f"Player {i + 1}"
+                tokens[i] = secrets.token_hex(TOKEN_BYTES)
+                connection.send(encode_batch([variant.rules_message(), f"ID:{i}:{tokens[i]}"]))
+                if all(clients):
+                    if waiting_since is not None:
+                        lobby_stats.record_match(time.perf_counter() - waiting_since, 0.0)
+                    waiting_since = None
+                    lobby_stats.queue_depth = 0
+                    if not game_active:
+                        # A fresh match: nothing of the previous pair's
+                        # board, turn or move list may carry over
+                        reset_game()
+                        log.info("Game starts!")
+                        broadcast_game_state()
+                else:
+                    waiting_since = time.perf_counter()
+                    lobby_stats.queue_depth = 1
+                return i
+    return None
 
-def start_server():
+def resume_seat(connection, token):
+    # Gives a reserved seat back to the player holding its token, with a
+    # full snapshot so the client needs nothing else to carry on
+    with lock:
+        for i in range(2):
+            if tokens[i] == token:
+                if clients[i] is not None:
+                    # The old connection has not noticed it is dead yet; its
+                    # thread sees the seat taken and leaves it alone
+                    clients[i].close()
+                if away_timers[i]:
+                    away_timers[i].cancel()
+                    away_timers[i] = None
+                clients[i] = connection
+                connection.name = f"Player {i + 1}"
+                connection.send(encode_batch([variant.rules_message(), f"ID:{i}:{token}", state_message()]))
+                broadcast_messages([f"BACK:{i}"], exclude=i)
+                return i
+    return None
+
+def read_hello(client, decoder):
+    # Clients open with PLAY or RESUME:token; older ones send nothing and
+    # are seated after HELLO_TIMEOUT
+    client.settimeout(HELLO_TIMEOUT)
+    try:
+        while True:
+            chunk = client.recv(4096)
+            if not chunk:
+                return None
+            messages = decoder.feed(chunk)
+            if messages:
+                return messages
+    except socket.timeout:
+        return []
+    finally:
+        client.settimeout(None)
+
+def admit(client, addr):
+    decoder = Decoder()
+    try:
+        pending = read_hello(client, decoder)
+    except (OSError, ProtocolError):
+        pending = None
+    if pending is None:
+        client.close()
+        return
+    hello = pending.pop(0) if pending and pending[0].startswith(("PLAY", "RESUME:", "SPECTATE")) else "PLAY"
+    if hello.startswith("SPECTATE"):
+        watch(client, addr, decoder, pending)
+        return
+
+    connection = Connection(client, "a player", metrics.evictions)
+    if hello == "PLAY:AI":
+        # AI opponents live in the asyncio server's rooms only
+        connection.send(encode("NOAI"))
+        connection.finish()
+        log.info("Rejected connection from %s: no AI opponent here", addr)
+        return
+    player_id = None
+    if hello.startswith("RESUME:"):
+        player_id = resume_seat(connection, hello.split(":", 1)[1])
+        if player_id is not None:
+            log.info("Player %d resumed from %s", player_id + 1, addr)
+            handle_client(connection, player_id, decoder, pending)
+            return
+    player_id = seat_player(connection)
+    if player_id is not None:
+        log.info("Player %d connected from %s", player_id + 1, addr)
+        if all(clients):
+            log.info(lobby_stats.report())
+        handle_client(connection, player_id, decoder, pending)
+    else:
+        connection.send(encode("FULL"))
+        connection.finish()
+        log.info("Rejected connection from %s: game full", addr)
+
+def start_server(port=PORT, metrics_port=None, metrics_interval=METRICS_INTERVAL, journal_path=None,
+                 game_variant=CLASSIC):
+    global journal, variant, board
+    variant = game_variant
+    board = Position(variant=variant)
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     try:
-        server_socket.bind((HOST, PORT))
-        server_socket.listen(2)
-        print(f"Server started on {HOST}:{PORT}. Waiting for players...")
+        server_socket.bind((HOST, port))
+        server_socket.listen(BACKLOG)
+        log.info("Server started on %s:%d. Waiting for players...", HOST, port)
+        if variant != CLASSIC:
+            log.info("Playing %s", variant)
+        if metrics_port:
+            Metrics.serve(metrics, HOST, metrics_port)
+            log.info("Metrics on http://%s:%d/metrics", HOST, metrics_port)
+        if metrics_interval:
+            Metrics.dump_periodically(metrics, metrics_interval, log)
+        if journal_path:
+            journal = Journal.JournalWriter(journal_path)
+            log.info("Recording games to %s", journal_path)
 
         while True:
             client, addr = server_socket.accept()
-            player_id = None
-            with lock:
-                for i in range(2):
-                    if clients[i] is None:
-                        clients[i] = client
-                        player_id = i
-                        break
-            if player_id is not None:
-                print(f"Player {player_id + 1} connected from {addr}")
-                client.send(f"ID:{player_id}".encode())
-                thread = threading.Thread(target=handle_client, args=(client, player_id), daemon=True)
-                thread.start()
-            else:
-                client.send("FULL".encode())
-                client.close()
-                print(f"Rejected connection from {addr}: game full")
+            # Updates are small and latency-bound: don't let Nagle hold them
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=admit, args=(client, addr), daemon=True).start()
     except Exception as e:
-        print(f"Server error: {e}")
+        log.error("Server error: %s", e)
     finally:
         for c in clients:
             if c:
-                try:
-                    c.close()
-                except:
-                    pass
+                c.close()
         server_socket.close()
-        print("Server stopped.")
+        if journal:
+            journal.close()
+        log.info("Server stopped.")
 
 if __name__ == "__main__":
-    start_server()
+    parser = argparse.ArgumentParser(description="Tic Tac Toe game server")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="host many rooms on one asyncio event loop")
+    parser.add_argument("--policy", default="tictactoe_policy.npz",
+                        help="exported AI policy for PLAY:AI rooms (async mode)")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--workers", type=int, default=0,
+                        help="run the async server in this many processes sharing the port")
+    parser.add_argument("--metrics-port", type=int, help="serve metrics over HTTP on this port")
+    parser.add_argument("--metrics-interval", type=float, default=METRICS_INTERVAL,
+                        help="seconds between metrics log lines (0: never)")
+    parser.add_argument("--log-level", default="INFO",
+                        help="DEBUG also logs every received message")
+    parser.add_argument("--journal", default=Journal.JOURNAL_PATH,
+                        help="append finished games to this file (empty: don't record)")
+    parser.add_argument("--board", type=Variant.parse, default=CLASSIC,
+                        help="board size and win length, e.g. 15x15:5 for gomoku (default 3x3:3)")
+    args = parser.parse_args()
+    listener = Metrics.setup_logging(args.log_level.upper())
+    # SIGTERM shuts down like Ctrl-C, so buffered journal records are saved
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        if args.workers:
+            import Supervisor
+            Supervisor.run_workers(args.workers, HOST, args.port, args.policy,
+                                   args.metrics_port, args.metrics_interval, args.log_level.upper(),
+                                   args.journal, args.board)
+        elif args.use_async:
+            import ServeurAsync
+            ServeurAsync.run(HOST, args.port, args.policy, args.metrics_port, args.metrics_interval,
+                             journal_path=args.journal, variant=args.board)
+        else:
+            start_server(args.port, args.metrics_port, args.metrics_interval, args.journal, args.board)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.stop()
@@ -0,0 +1,645 @@
+import asyncio
+import itertools
+import logging
+import secrets
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+import Book
+import Journal
+import Metrics
+from Engine import CLASSIC, Position
+from Matchmaking import Matchmaker
+from Protocol import Decoder, ProtocolError, encode, encode_batch
+
+# Server configuration
+HOST = "127.0.0.1"
+PORT = 5555
+BACKLOG = 1024
+STATS_INTERVAL = 10
+HELLO_TIMEOUT = 0.5
+MAX_AI_BATCH = 1024
+# How long a worker of a sharded server lets a player wait for a local
+# opponent before passing the connection to worker 0
+HANDOFF_DELAY = 0.2
+# A dropped player keeps its seat this long, waiting for RESUME:token
+RESUME_GRACE = 15
+TOKEN_BYTES = 8
+# Bytes a spectator may leave unread before it is disconnected, so a slow
+# watcher costs bounded memory and never holds up the room
+SPECTATOR_BUFFER = 64 * 1024
+# Same for a player, whose buffer only grows if it stopped reading (the
+# threaded server's HIGH_WATER), and how long its own read loop waits for
+# the buffer to drain before giving up
+PLAYER_BUFFER = 64 * 1024
+WRITE_TIMEOUT = 5
+POLICY_PATH = "tictactoe_policy.npz"
+log = logging.getLogger("serveur")
+
+
+# One independent match: its own board, turn and pair of player slots
+class Room:
+    def __init__(self, room_id, metrics=None, journal=None, variant=CLASSIC):
+        self.room_id = room_id
+        self.variant = variant
+        self.metrics = metrics or Metrics.ServerMetrics()
+        self.journal = journal
+        # Cells played in the current game, journaled when it ends
+        self.moves = []
+        self.players = [None, None]
+        self.board = Position(variant=variant)
+        self.current_turn = 0
+        self.game_active = False
+        self.ai_seat = None
+        self.ai_thinking = False
+        # Bumped on every move and reset; seats that sent DELTA receive
+        # "DELTA:seq:cell:symbol:turn" after a move instead of a full STATE
+        self.seq = 0
+        self.delta_players = [False, False]
+        # Resume token of each human seat, and the pending expiry of seats
+        # whose player dropped without saying QUIT
+        self.tokens = [None, None]
+        self.away_timers = [None, None]
+        # Read-only watchers: writer -> whether it asked for DELTA updates
+        self.spectators = {}
+
+    def is_full(self):
+        return all(self.players)
+
+    def is_empty(self):
+        return all(player is None for seat, player in enumerate(self.players)
+                   if seat != self.ai_seat)
+
+    def needs_ai_move(self):
+        return self.ai_seat is not None and self.game_active and self.current_turn == self.ai_seat
+
+    def state_message(self):
+        return "STATE:" + ",".join(self.board.cells()) + ":" + str(self.current_turn) + ":" + str(self.seq)
+
+    def send_game_state(self, player_id):
+        if self.players[player_id]:
+            self.send(self.players[player_id], encode(self.state_message()))
+
+    def send(self, writer, data):
+        # write() never blocks, it queues; a player that lets PLAYER_BUFFER
+        # bytes pile up is aborted rather than queued for without bound, and
+        # its serve_player then drops it like any lost connection
+        transport = writer.transport
+        if transport is None or transport.get_write_buffer_size() <= PLAYER_BUFFER:
+            writer.write(data)
+        elif not transport.is_closing():
+            log.warning("Room %d: evicting a player that does not read its updates", self.room_id)
+            self.metrics.evictions.inc()
+            transport.abort()
+
+    def broadcast_game_state(self):
+        self.broadcast_messages([self.state_message()])
+
+    def broadcast_message(self, message):
+        self.broadcast_messages([message])
+
+    def broadcast_messages(self, messages, exclude=None):
+        data = encode_batch(messages)
+        for player_id, writer in enumerate(self.players):
+            if writer and player_id != exclude:
+                self.send(writer, data)
+        self.fan_out(lambda mode: data)
+
+    def broadcast_update(self, messages, delta):
+        # Each encoding is built at most once, whatever the number of receivers
+        encoded = {}
+        def encoding(mode):
+            if mode not in encoded:
+                encoded[mode] = encode_batch(messages + [delta if mode else self.state_message()])
+            return encoded[mode]
+        for writer, mode in zip(self.players, self.delta_players):
+            if writer:
+                self.send(writer, encoding(mode))
+        self.fan_out(encoding)
+
+    def fan_out(self, encoding):
+        # write() only queues the bytes; a spectator whose queue is already
+        # past SPECTATOR_BUFFER is cut off instead of growing it further
+        for writer, mode in list(self.spectators.items()):
+            if writer.transport.get_write_buffer_size() > SPECTATOR_BUFFER:
+                log.info("Room %d: dropping a spectator that does not keep up", self.room_id)
+                self.metrics.spectators_dropped.inc()
+                self.remove_spectator(writer)
+                writer.transport.abort()
+            else:
+                writer.write(encoding(mode))
+
+    def add_spectator(self, writer, delta=False):
+        self.spectators[writer] = delta
+        self.metrics.spectators.inc()
+        writer.write(encode_batch([f"SPECTATING:{self.room_id}", self.variant.rules_message(),
+                                   self.state_message()]))
+
+    def remove_spectator(self, writer):
+        if self.spectators.pop(writer, None) is not None:
+            self.metrics.spectators.dec()
+
+    def check_winner(self):
+        return self.board.winner()
+
+    def start(self):
+        self.moves = []
+        self.set_active(True)
+        self.broadcast_game_state()
+
+    def set_active(self, active):
+        if active != self.game_active:
+            self.metrics.games.inc(1 if active else -1)
+        self.game_active = active
+
+    def reset_game(self):
+        self.board = Position(variant=self.variant)
+        self.moves = []
+        self.current_turn = 0
+        self.set_active(True)
+        self.seq += 1
+
+    def play(self, player_id, position):
+        if not self.game_active or self.current_turn != player_id:
+            return
+        if not self.board.is_free(position):
+            return
+        self.board.play(position, player_id)
+        self.moves.append(position)
+        self.metrics.moves.inc()
+        self.seq += 1
+        winner = self.check_winner()
+        messages = []
+        if winner:
+            if winner == "TIE":
+                messages.append("RESULT:TIE")
+            else:
+                winning_player = 0 if winner == "X" else 1
+                messages.append(f"RESULT:WIN:{winning_player}")
+            self.set_active(False)
+            self.journal_game(Journal.result_code(winner))
+        else:
+            self.current_turn = 1 - player_id
+        delta = f"DELTA:{self.seq}:{position}:{'XO'[player_id]}:{self.current_turn}"
+        self.broadcast_update(messages, delta)
+
+    def handle_message(self, player_id, data):
+        if data.startswith("MOVE:"):
+            try:
+                self.play(player_id, int(data.split(":")[1]))
+            except ValueError:
+                log.warning("Room %d: invalid move format from Player %d", self.room_id, player_id + 1)
+        elif data == "RESET" and not self.game_active and player_id == 0 and self.is_full():
+            self.reset_game()
+            self.broadcast_messages(["RESET", self.state_message()])
+        elif data == "DELTA":
+            self.delta_players[player_id] = True
+        elif data == "SYNC":
+            self.send_game_state(player_id)
+
+    def journal_game(self, result):
+        # Journal records have room for the classic board only
+        if self.journal and self.moves and self.variant == CLASSIC:
+            flags = Journal.FLAG_AI if self.ai_seat is not None else 0
+            self.journal.record(self.room_id, self.moves, result, flags)
+
+    def is_held(self, player_id):
+        # True while the other seat has someone, connected or about to
+        # resume, worth keeping the game alive for
+        other = 1 - player_id
+        return other == self.ai_seat or self.tokens[other] is not None
+
+    def leave(self, player_id):
+        self.players[player_id] = None
+        self.tokens[player_id] = None
+        self.delta_players[player_id] = False
+        self.broadcast_message(f"DISCONNECT:{player_id}")
+        if self.game_active:
+            self.journal_game(Journal.RESULT_ABANDONED)
+        self.set_active(False)
+
+
+# Sits in the AI's seat; room broadcasts to it are simply dropped
+class AIOpponent:
+    transport = None
+
+    def write(self, data):
+        pass
+
+
+# Gathers the AI move requests of every room and answers them with one
+# batched predict call on a dedicated thread. Requests that arrive while a
+# batch is running are collected into the next one.
+class InferenceWorker:
+    def __init__(self, policy, max_batch=MAX_AI_BATCH):
+        self.policy = policy
+        self.max_batch = max_batch
+        self.pending = []
+        self.wakeup = asyncio.Event()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+        self.batches = 0
+        self.requests = 0
+
+    def request(self, board):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((board.codes(), future))
+        self.wakeup.set()
+        return future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            while self.pending:
+                batch = self.pending[:self.max_batch]
+                del self.pending[:self.max_batch]
+                actions = await loop.run_in_executor(self.executor, self.policy.predict,
+                                                     [codes for codes, _ in batch])
+                for (_, future), action in zip(batch, actions):
+                    if not future.done():
+                        future.set_result(int(action))
+                self.batches += 1
+                self.requests += len(batch)
+
+
+def load_ai_policy(policy_path=POLICY_PATH):
+    try:
+        from Inference import NumpyPolicy
+        return NumpyPolicy.load(policy_path)
+    except (ImportError, OSError) as e:
+        log.warning("No exported policy (%s), the AI plays from the solved book", e)
+        return Book.load()
+
+
+# Hosts any number of rooms on a single event loop, no thread per client
+class AsyncGameServer:
+    def __init__(self, host=HOST, port=PORT, policy_path=POLICY_PATH,
+                 metrics_port=None, stats_interval=STATS_INTERVAL, worker_id=None, handoffs=None,
+                 journal_path=None, variant=CLASSIC):
+        self.host = host
+        self.port = port
+        self.variant = variant
+        # Set when running as one worker of Supervisor.run_workers;
+        # handoffs[n] is the (inbox, outbox) datagram pair of worker n
+        self.worker_id = worker_id
+        self.handoffs = handoffs
+        self.sessions = {}
+        self.metrics = Metrics.ServerMetrics()
+        self.metrics.gauge("rooms", "Open rooms", lambda: len(self.rooms))
+        self.metrics_port = metrics_port
+        self.stats_interval = stats_interval
+        self.rooms = {}
+        # Sharded workers number their rooms worker_id + 1, + workers, ... so
+        # room ids are unique across workers and name their owner
+        if handoffs:
+            self.room_ids = itertools.count(worker_id + 1, len(handoffs))
+        else:
+            self.room_ids = itertools.count(1)
+        self.matchmaker = Matchmaker(self.create_room)
+        self.policy_path = policy_path
+        self.inference = None
+        if journal_path and worker_id is not None:
+            journal_path = Journal.worker_path(journal_path, worker_id)
+        self.journal_path = journal_path
+        self.journal = None
+
+    def create_room(self, first, second):
+        room = Room(next(self.room_ids), self.metrics, self.journal, self.variant)
+        room.players = [first, second]
+        self.rooms[room.room_id] = room
+        for player_id, writer in enumerate(room.players):
+            writer.write(encode_batch([self.variant.rules_message(),
+                                       f"ID:{player_id}:{self.new_session(room, player_id)}"]))
+        room.start()
+        return room
+
+    def create_ai_room(self, writer):
+        # The policy and the book only know the classic board, so AI rooms
+        # stay 3x3 whatever the server's variant
+        room = Room(next(self.room_ids), self.metrics, self.journal)
+        room.players = [writer, AIOpponent()]
+        room.ai_seat = 1
+        self.rooms[room.room_id] = room
+        writer.write(encode_batch([CLASSIC.rules_message(), f"ID:0:{self.new_session(room, 0)}"]))
+        room.start()
+        return room, 0
+
+    def new_session(self, room, player_id):
+        # Tokens name the worker that owns the room, so a RESUME landing on
+        # another worker can be routed back to it
+        token = secrets.token_hex(TOKEN_BYTES)
+        if self.worker_id is not None:
+            token = f"{self.worker_id}.{token}"
+        room.tokens[player_id] = token
+        self.sessions[token] = (room, player_id)
+        return token
+
+    def token_owner(self, token):
+        worker, _, _ = token.partition(".")
+        if self.handoffs and worker.isdigit() and int(worker) < len(self.handoffs):
+            return int(worker)
+        return self.worker_id
+
+    def resume(self, token, writer):
+        session = self.sessions.get(token)
+        if session is None:
+            return None
+        room, player_id = session
+        old = room.players[player_id]
+        if old is not None:
+            # The old connection has not noticed it is dead yet
+            old.close()
+        if room.away_timers[player_id]:
+            room.away_timers[player_id].cancel()
+            room.away_timers[player_id] = None
+        room.players[player_id] = writer
+        writer.write(encode_batch([room.variant.rules_message(), f"ID:{player_id}:{token}",
+                                   room.state_message()]))
+        room.broadcast_messages([f"BACK:{player_id}"], exclude=player_id)
+        return room, player_id
+
+    async def play_ai_move(self, room):
+        room.ai_thinking = True
+        try:
+            move = await self.inference.request(room.board)
+        finally:
+            room.ai_thinking = False
+        # The player may have left or the board changed while we waited
+        if room.needs_ai_move():
+            room.play(room.ai_seat, move)
+
+    def dispatch(self, room, player_id, data):
+        received = time.perf_counter()
+        log.debug("Room %d: received from Player %d: %s", room.room_id, player_id + 1, data)
+        room.handle_message(player_id, data)
+        if room.needs_ai_move() and not room.ai_thinking:
+            asyncio.ensure_future(self.play_ai_move(room))
+        self.metrics.message_latency.observe(time.perf_counter() - received)
+
+    def leave(self, room, player_id):
+        self.sessions.pop(room.tokens[player_id], None)
+        room.leave(player_id)
+        if room.is_empty():
+            self.rooms.pop(room.room_id, None)
+            for writer in list(room.spectators):
+                room.remove_spectator(writer)
+                writer.close()
+
+    def drop(self, room, player_id, writer, quitting):
+        if room.players[player_id] is not writer:
+            return  # replaced by a resumed connection
+        if quitting or not room.is_held(player_id):
+            self.leave(room, player_id)
+            return
+        room.players[player_id] = None
+        room.broadcast_message(f"AWAY:{player_id}")
+        room.away_timers[player_id] = asyncio.get_running_loop().call_later(
+            RESUME_GRACE, self.expire, room, player_id)
+
+    def expire(self, room, player_id):
+        room.away_timers[player_id] = None
+        log.info("Player %d of room %d did not come back", player_id + 1, room.room_id)
+        self.leave(room, player_id)
+
+    async def wait_for_match(self, reader, writer, decoder, pending):
+        # Parks the connection until an opponent arrives, while still
+        # noticing if the player hangs up in the meantime. Returns the room
+        # and the seat; messages read meanwhile are added to pending.
+        ticket = self.matchmaker.enqueue(writer)
+        loop = asyncio.get_running_loop()
+        can_hand_off = self.handoffs is not None and self.worker_id != 0
+        deadline = loop.time() + HANDOFF_DELAY
+        try:
+            while not ticket.future.done():
+                read_task = asyncio.ensure_future(reader.read(4096))
+                timeout = max(0, deadline - loop.time()) if can_hand_off else None
+                await asyncio.wait({ticket.future, read_task}, timeout=timeout,
+                                   return_when=asyncio.FIRST_COMPLETED)
+                if not read_task.done():
+                    read_task.cancel()
+                    try:
+                        await read_task
+                    except asyncio.CancelledError:
+                        if ticket.future.done():
+                            break
+                        # Nobody showed up here: worker 0 gathers the
+                        # stragglers of every worker
+                        self.matchmaker.cancel(ticket)
+                        self.hand_off(writer, ["PLAY"] + pending, decoder, 0)
+                        return None
+                chunk = read_task.result()
+                if not chunk:
+                    raise ConnectionResetError("disconnected while waiting for an opponent")
+                pending.extend(decoder.feed(chunk))
+        except (ConnectionError, ProtocolError):
+            if ticket.future.done():
+                self.leave(*ticket.future.result())
+            self.matchmaker.cancel(ticket)
+            return None
+        return ticket.future.result()
+
+    def hand_off(self, writer, messages, decoder, worker):
+        # The socket is duplicated into another worker along with everything
+        # the player sent so far, which that worker replays as if freshly
+        # received. Closing our transport afterwards only drops our fd.
+        payload = encode_batch(messages) + bytes(decoder.buffer)
+        sock = writer.get_extra_info("socket")
+        socket.send_fds(self.handoffs[worker][1], [payload], [sock.fileno()])
+
+    def adopt_handoff(self):
+        try:
+            payload, fds, _, _ = socket.recv_fds(self.handoffs[self.worker_id][0], 64 * 1024, 1)
+        except BlockingIOError:
+            return
+        if fds:
+            asyncio.ensure_future(self.adopt(socket.socket(fileno=fds[0]), payload))
+
+    async def adopt(self, sock, payload):
+        reader, writer = await asyncio.open_connection(sock=sock)
+        reader.feed_data(payload)
+        await self.handle_connection(reader, writer)
+
+    async def read_hello(self, reader, decoder):
+        # Clients open with PLAY (quick match), PLAY:AI or RESUME:token. Older
+        # clients that send nothing go to the quick-match queue after
+        # HELLO_TIMEOUT.
+        async def first_messages():
+            while True:
+                chunk = await reader.read(4096)
+                if not chunk:
+                    raise ConnectionResetError("disconnected before saying hello")
+                messages = decoder.feed(chunk)
+                if messages:
+                    return messages
+        try:
+            return await asyncio.wait_for(first_messages(), HELLO_TIMEOUT)
+        except asyncio.TimeoutError:
+            return []
+
+    async def handle_connection(self, reader, writer):
+        decoder = Decoder()
+        try:
+            pending = await self.read_hello(reader, decoder)
+        except (ConnectionError, ProtocolError):
+            writer.close()
+            return
+        hello = pending[0] if pending else ""
+        intent = pending.pop(0) if hello.startswith(("PLAY", "RESUME:", "SPECTATE")) else "PLAY"
+        if intent.startswith("SPECTATE"):
+            await self.spectate(reader, writer, decoder, intent, pending)
+            return
+        # Players only, waiting or seated, as on the threaded server: not
+        # spectators, nor sockets that never said hello
+        self.metrics.connections.inc()
+        try:
+            await self.serve_player(reader, writer, decoder, intent, pending)
+        finally:
+            self.metrics.connections.dec()
+
+    async def serve_player(self, reader, writer, decoder, intent, pending):
+        addr = writer.get_extra_info("peername")
+        match = None
+        if intent.startswith("RESUME:"):
+            token = intent.split(":", 1)[1]
+            owner = self.token_owner(token)
+            if owner != self.worker_id:
+                self.hand_off(writer, [intent] + pending, decoder, owner)
+                writer.close()
+                return
+            match = self.resume(token, writer)
+            if match:
+                log.info("Player %d resumed from %s (room %d)", match[1] + 1, addr, match[0].room_id)
+        if match is None:
+            if intent == "PLAY:AI":
+                match = self.create_ai_room(writer)
+            else:
+                match = await self.wait_for_match(reader, writer, decoder, pending)
+                if match is None:
+                    writer.close()
+                    return
+            log.info("Player %d connected from %s (room %d)", match[1] + 1, addr, match[0].room_id)
+        room, player_id = match
+
+        quitting = False
+        try:
+            for data in pending:
+                self.dispatch(room, player_id, data)
+            while not quitting:
+                chunk = await reader.read(4096)
+                if not chunk:
+                    break
+                for data in decoder.feed(chunk):
+                    if data == "QUIT":
+                        quitting = True
+                        break
+                    self.dispatch(room, player_id, data)
+                try:
+                    await asyncio.wait_for(writer.drain(), WRITE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    self.metrics.evictions.inc()
+                    raise ConnectionResetError("write timed out")
+                except ConnectionError:
+                    self.metrics.send_failures.inc()
+                    raise
+        except (ConnectionError, ProtocolError) as e:
+            log.warning("Error with Player %d in room %d: %s", player_id + 1, room.room_id, e)
+        finally:
+            self.drop(room, player_id, writer, quitting)
+            writer.close()
+
+    async def spectate(self, reader, writer, decoder, intent, pending):
+        # SPECTATE:<room> watches that room, plain SPECTATE the newest one.
+        # Spectators may send DELTA, SYNC and QUIT; anything else is ignored.
+        room_id = intent.partition(":")[2]
+        if room_id.isdigit():
+            room_id = int(room_id)
+            owner = (room_id - 1) % len(self.handoffs) if self.handoffs else self.worker_id
+            if owner != self.worker_id:
+                self.hand_off(writer, [intent] + pending, decoder, owner)
+                writer.close()
+                return
+            room = self.rooms.get(room_id)
+        else:
+            room = next(reversed(self.rooms.values()), None)
+        if room is None:
+            writer.write(encode("NOROOM"))
+            writer.close()
+            return
+        room.add_spectator(writer, "DELTA" in pending)
+        log.info("Spectator joined room %d (%d watching)", room.room_id, len(room.spectators))
+        try:
+            while writer in room.spectators:
+                chunk = await reader.read(4096)
+                if not chunk:
+                    break
+                for data in decoder.feed(chunk):
+                    if data == "QUIT":
+                        return
+                    if data == "DELTA" and writer in room.spectators:
+                        room.spectators[writer] = True
+                    elif data == "SYNC":
+                        writer.write(encode(room.state_message()))
+        except (ConnectionError, ProtocolError):
+            pass
+        finally:
+            room.remove_spectator(writer)
+            writer.close()
+
+    async def report_stats(self):
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            log.info("%s AI: %d moves in %d batches", self.matchmaker.stats.report(),
+                     self.inference.requests, self.inference.batches)
+            log.info("Metrics: %s", self.metrics.report())
+
+    async def serve_forever(self):
+        # Workers all bind the same port and the kernel spreads the
+        # incoming connections between them
+        server = await asyncio.start_server(self.handle_connection, self.host, self.port,
+                                            backlog=BACKLOG, reuse_address=True,
+                                            reuse_port=self.worker_id is not None)
+        log.info("Async server started on %s:%d. Waiting for players...", self.host, self.port)
+        if self.variant != CLASSIC:
+            log.info("Playing %s", self.variant)
+        if self.handoffs is not None:
+            inbox = self.handoffs[self.worker_id][0]
+            inbox.setblocking(False)
+            asyncio.get_running_loop().add_reader(inbox.fileno(), self.adopt_handoff)
+        if self.metrics_port:
+            Metrics.serve(self.metrics, self.host, self.metrics_port)
+            log.info("Metrics on http://%s:%d/metrics", self.host, self.metrics_port)
+        if self.journal_path:
+            self.journal = Journal.JournalWriter(self.journal_path)
+            log.info("Recording games to %s", self.journal_path)
+        self.inference = InferenceWorker(load_ai_policy(self.policy_path))
+        tasks = [asyncio.ensure_future(self.inference.run())]
+        if self.stats_interval:
+            tasks.append(asyncio.ensure_future(self.report_stats()))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in tasks:
+                task.cancel()
+            if self.journal:
+                self.journal.close()
+
+
+def run(host=HOST, port=PORT, policy_path=POLICY_PATH, metrics_port=None, stats_interval=STATS_INTERVAL,
+        worker_id=None, handoffs=None, journal_path=None, variant=CLASSIC):
+    server = AsyncGameServer(host, port, policy_path, metrics_port, stats_interval, worker_id, handoffs,
+                             journal_path, variant)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+    log.info("Server stopped.")
+
+
+if __name__ == "__main__":
+    listener = Metrics.setup_logging()
+    try:
+        run()
+    finally:
+        listener.stop()
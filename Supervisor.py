@@ -0,0 +1,70 @@
+import logging
+import os
+import signal
+import socket
+import time
+import Metrics
+import ServeurAsync
+
+# A worker that dies sooner than this after starting is not restarted: it
+# would most likely fail the same way again (port in use, bad policy...)
+MIN_UPTIME = 1.0
+log = logging.getLogger("serveur")
+
+
+# Forks one asyncio game server per worker, all listening on the same port
+# with SO_REUSEPORT so the kernel balances new connections between them.
+# Each worker owns the rooms it creates; a player left without a local
+# opponent is passed to worker 0 (see AsyncGameServer.hand_off), so both
+# players of a game always end up in the same process, and a RESUME is
+# passed to the worker named in its token.
+def run_workers(workers, host=ServeurAsync.HOST, port=ServeurAsync.PORT,
+                policy_path=ServeurAsync.POLICY_PATH, metrics_port=None,
+                stats_interval=ServeurAsync.STATS_INTERVAL, log_level="INFO", journal_path=None,
+                variant=ServeurAsync.CLASSIC):
+    if not hasattr(os, "fork") or not hasattr(socket, "SO_REUSEPORT"):
+        raise RuntimeError("Worker processes need fork() and SO_REUSEPORT (Linux, BSD, macOS)")
+    # One datagram pair per worker: it reads its inbox end, the others send
+    # to its outbox end, one connection per datagram
+    handoffs = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for _ in range(workers)]
+    children = {}
+
+    def spawn(worker_id):
+        pid = os.fork()
+        if pid == 0:
+            # The SIGTERM handler below is inherited: a worker stops like on
+            # Ctrl-C, closing its journal on the way out
+            listener = Metrics.setup_logging(log_level, f"[worker {worker_id}] ")
+            try:
+                ServeurAsync.run(host, port, policy_path,
+                                 metrics_port and metrics_port + worker_id, stats_interval,
+                                 worker_id, handoffs, journal_path, variant)
+            finally:
+                listener.stop()
+                os._exit(0)
+        children[pid] = (worker_id, time.monotonic())
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+    for worker_id in range(workers):
+        spawn(worker_id)
+    log.info("Supervisor started %d workers on %s:%d", workers, host, port)
+    try:
+        while children:
+            pid, status = os.wait()
+            worker_id, started = children.pop(pid)
+            if time.monotonic() - started < MIN_UPTIME:
+                log.error("Worker %d exited right after starting (status %d)", worker_id, status)
+                break
+            log.warning("Worker %d exited (status %d), restarting it", worker_id, status)
+            spawn(worker_id)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+        for pid in children:
+            os.waitpid(pid, 0)
+        log.info("Server stopped.")
@@ -1,85 +1,30 @@
 import pygame
 import sys
+import argparse
 import random
 import numpy as np
-from gym import Env, spaces
-from stable_baselines3 import PPO  
 import os
-
-# Initialize pygame
-pygame.init()
+import Book
+from Inference import MODEL_PATH, POLICY_PATH, NumpyPolicy, export_policy
+from Engine import Position
+from Renderer import Renderer, load_image, open_window
 
 # Constants
 WIDTH, HEIGHT = 500, 500
 SQUARE_SIZE = 120
 MARGIN = 20
-FONT = pygame.font.Font(None, 40)
-
-# Load images
-blank_image = pygame.image.load('Blank.png')
-x_image = pygame.image.load('x.png')
-o_image = pygame.image.load('o.png')
-Background = pygame.image.load('NewBackground.jpeg')
-Background = pygame.transform.scale(Background, (WIDTH, HEIGHT))
 
-# Create Pygame window
-win = pygame.display.set_mode((WIDTH, HEIGHT))
-pygame.display.set_caption('Tic Tac Toe')
-clock = pygame.time.Clock()
+# Window, renderer and images are only set up by main(), so the game logic
+# and the AI below can be imported without opening a window
+win = None
+renderer = None
+square_sources = {}
 
 # Game variables
 current_player = "X"
 game_over = False
-board = [[" " for _ in range(3)] for _ in range(3)]
-
-class TicTacToeEnv(Env):
-    def __init__(self):
-        super(TicTacToeEnv, self).__init__()
-        self.action_space = spaces.Discrete(9)
-        self.observation_space = spaces.Box(low=0, high=2, shape=(9,), dtype=np.int32)
-        self.reset()
-        
-    def reset(self):
-        self.board = [" " for _ in range(9)]
-        self.current_player = "X"
-        self.done = False
-        return self._get_obs()
-    
-    def _get_obs(self):
-        obs = [0 if cell == " " else 1 if cell == "X" else 2 for cell in self.board]
-        return np.array(obs, dtype=np.int32)
-    
-    def step(self, action):
-        if self.done or self.board[action] != " ":
-            return self._get_obs(), -10, True, {}
-
-        self.board[action] = self.current_player
-        winner = self._check_winner()
-        if winner:
-            self.done = True
-            reward = 1 if winner == "O" else -1 if winner == "X" else 0
-            return self._get_obs(), reward, True, {}
-
-        self.current_player = "O" if self.current_player == "X" else "X"
-        return self._get_obs(), 0, False, {}
-    
-    def _check_winner(self):
-        b = self.board
-        for i in range(0, 9, 3):
-            if b[i] == b[i+1] == b[i+2] != " ": return b[i]
-        for i in range(3):
-            if b[i] == b[i+3] == b[i+6] != " ": return b[i]
-        if b[0] == b[4] == b[8] != " ": return b[0]
-        if b[2] == b[4] == b[6] != " ": return b[2]
-        if " " not in b: return "Draw"
-        return None
-
-def train_model(total_timesteps=50000, save_path="tictactoe_model"):
-    env = TicTacToeEnv()
-    model = PPO("MlpPolicy", env, verbose=1)
-    model.learn(total_timesteps=total_timesteps)
-    model.save(save_path)
-    print(f"Model trained and saved to {save_path}")
+board = Position()
+highlighted = None
 
 class Board(pygame.sprite.Sprite):
     def __init__(self, x_id, y_id, number):
@@ -90,121 +35,166 @@ class Board(pygame.sprite.Sprite):
         self.y = y_id * self.height + MARGIN
         self.content = ' '
         self.number = number
-        self.image = pygame.transform.scale(blank_image, (self.width, self.height))
+        self.image = self.scaled_image()
         self.rect = self.image.get_rect()
         self.rect.topleft = (self.x, self.y)
 
+    def scaled_image(self):
+        return renderer.scaled_image(self.content, square_sources[self.content], (self.width, self.height))
+
     def update(self):
-        if self.content == "X":
-            self.image = pygame.transform.scale(x_image, (self.width, self.height))
-        elif self.content == "O":
-            self.image = pygame.transform.scale(o_image, (self.width, self.height))
-        else:
-            self.image = pygame.transform.scale(blank_image, (self.width, self.height))
+        global highlighted
+        self.image = self.scaled_image()
+        renderer.draw_sprite(self)
+        if highlighted is self:
+            highlighted = None
 
     def highlight(self):
         pygame.draw.rect(win, (0, 255, 0), self.rect, 3)
+        renderer.mark(self.rect)
 
 def check_winner():
-    for row in board:
-        if row[0] == row[1] == row[2] and row[0] != " ":
-            return row[0]
-    for col in range(3):
-        if board[0][col] == board[1][col] == board[2][col] != " ":
-            return board[0][col]
-    if board[0][0] == board[1][1] == board[2][2] != " ":
-        return board[0][0]
-    if board[0][2] == board[1][1] == board[2][0] != " ":
-        return board[0][2]
-    if all(board[r][c] != " " for r in range(3) for c in range(3)):
-        return "Draw"
-    return None
-
-# Load or train model
-if os.path.exists("tictactoe_model.zip"):
-    model = PPO.load("tictactoe_model")
-else:
-    train_model()
-    model = PPO.load("tictactoe_model")
+    return board.winner()
+
+# Where the AI's moves come from: "ppo" (policy only), "book" (solved
+# table only) or "blend" (policy move, replaced by the book's move whenever
+# it would throw away a win or a draw). The policy is masked to free cells,
+# so each move costs exactly one forward pass.
+AI_MODE = "blend"
+book = None
+model = None
+
+def load_policy():
+    # Play only needs the exported NumPy weights; torch and stable_baselines3
+    # are imported only when there is no model yet and one must be trained.
+    # An interrupted training carries on from its last checkpoint.
+    model_zip = MODEL_PATH + ".zip"
+    if not os.path.exists(POLICY_PATH) and not os.path.exists(model_zip):
+        from Training import train_model
+        train_model(save_path=MODEL_PATH, resume=True)
+    if os.path.exists(model_zip) and (not os.path.exists(POLICY_PATH)
+                                      or os.path.getmtime(POLICY_PATH) < os.path.getmtime(model_zip)):
+        export_policy(MODEL_PATH, POLICY_PATH)
+    return NumpyPolicy.load(POLICY_PATH)
+
+def load_ai(mode=AI_MODE):
+    # Loads (or trains) the AI on first use only
+    global book, model
+    if book is None:
+        book = Book.load()
+    if model is None and mode != "book":
+        model = load_policy()
+
+def choose_move(position, mode=AI_MODE):
+    load_ai(mode)
+    if mode == "book":
+        return book.best_move(position)
+    obs = np.array(position.codes(), dtype=np.int32)
+    action = model.predict(obs)
+    if mode == "blend" and not book.is_optimal(position, action):
+        action = book.best_move(position)
+    return action
 
 def ai_move():
-    obs = [0 if cell == " " else 1 if cell == "X" else 2 for row in board for cell in row]
-    obs = np.array(obs, dtype=np.int32)
-    for _ in range(10):
-        action, _ = model.predict(obs)
-        r, c = action // 3, action % 3
-        if board[r][c] == " ":
-            board[r][c] = "O"
-            squares[r * 3 + c].content = "O"
-            squares[r * 3 + c].update()
-            return True
-    return False
+    action = choose_move(board)
+    if action is None:
+        return False
+    board.play(action, 1)
+    squares[action].content = "O"
+    squares[action].update()
+    return True
 
 def update_display():
-    win.blit(Background, (0, 0))
-    square_group.draw(win)
+    global highlighted
+    if renderer.begin_frame(squares):
+        highlighted = None
+
+    hovered = None
     for square in squares:
         if square.rect.collidepoint(pygame.mouse.get_pos()) and square.content == ' ' and current_player == "X" and not game_over:
-            square.highlight()
+            hovered = square
+    if hovered is not highlighted:
+        if highlighted:
+            renderer.draw_sprite(highlighted)
+        if hovered:
+            hovered.highlight()
+        highlighted = hovered
 
     winner = check_winner()
     if winner:
-        text = FONT.render(f'{winner} wins!' if winner != "Draw" else "It\'s a draw!", True, (255, 255, 255))
-        win.blit(text, (WIDTH // 3, HEIGHT - 50))
-        reset_text = FONT.render("Press R to restart", True, (255, 255, 255))
-        win.blit(reset_text, (WIDTH // 3 - 40, HEIGHT - 20))
+        renderer.show_text("status", f'{winner} wins!' if winner != "TIE" else "It\'s a draw!",
+                           topleft=(WIDTH // 3, HEIGHT - 50))
+        renderer.show_text("hint", "Press R to restart", topleft=(WIDTH // 3 - 40, HEIGHT - 20))
     else:
-        turn_text = FONT.render(f"Turn: {current_player}", True, (255, 255, 255))
-        win.blit(turn_text, (WIDTH // 3, HEIGHT - 50))
+        renderer.show_text("status", f"Turn: {current_player}", topleft=(WIDTH // 3, HEIGHT - 50))
+        renderer.hide("hint")
 
-    pygame.display.update()
+    renderer.flush()
 
-# Create board squares
-square_group = pygame.sprite.Group()
 squares = []
-num = 1
-for y in range(3):  
-    for x in range(3):
-        sq = Board(x, y, num)
-        square_group.add(sq)
-        squares.append(sq)
-        num += 1 
-
-# Game loop
-run = True
-game_over = False
-while run:
-    clock.tick(60)
-    
-    for event in pygame.event.get():
-        if event.type == pygame.QUIT:
-            run = False
-
-        if event.type == pygame.MOUSEBUTTONDOWN and not game_over:
-            mx, my = pygame.mouse.get_pos()
-            for square in squares:
-                if square.rect.collidepoint(mx, my) and square.content == ' ' and current_player == "X":
-                    r, c = (square.number - 1) // 3, (square.number - 1) % 3
-                    square.content = "X"
-                    board[r][c] = "X"
-                    square.update()
-                    game_over = check_winner() is not None
-                    current_player = "O" if not game_over else "X"
-                    if not game_over:
-                        ai_move()
-                        game_over = check_winner() is not None
-                        current_player = "X"
 
-        if event.type == pygame.KEYDOWN and game_over:
-            if event.key == pygame.K_r:
-                board = [[" " for _ in range(3)] for _ in range(3)]
+def main(argv=None):
+    global win, renderer, square_sources, squares, board, current_player, game_over
+    parser = argparse.ArgumentParser(description="Play Tic Tac Toe against the AI")
+    parser.add_argument("--headless", action="store_true",
+                        help="no window: draw offscreen with SDL's dummy video driver")
+    args = parser.parse_args(argv)
+
+    # The AI is ready before the first frame, so the first move never waits
+    load_ai()
+    win = open_window((WIDTH, HEIGHT), 'Tic Tac Toe', args.headless)
+    clock = pygame.time.Clock()
+    renderer = Renderer(win, load_image('NewBackground.jpeg', (WIDTH, HEIGHT)), pygame.font.Font(None, 40))
+    square_sources = {"X": load_image('x.png'), "O": load_image('o.png'), " ": load_image('Blank.png')}
+
+    # Create board squares
+    squares = []
+    num = 1
+    for y in range(3):
+        for x in range(3):
+            squares.append(Board(x, y, num))
+            num += 1
+
+    # Game loop
+    run = True
+    game_over = False
+    while run:
+        clock.tick(60)
+
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                run = False
+
+            if event.type in (pygame.VIDEOEXPOSE, pygame.WINDOWEXPOSED):
+                renderer.invalidate()
+
+            if event.type == pygame.MOUSEBUTTONDOWN and not game_over:
+                mx, my = pygame.mouse.get_pos()
                 for square in squares:
-                    square.content = ' '
-                    square.update()
-                current_player = "X"
-                game_over = False
-
-    update_display()
-
-pygame.quit()
-sys.exit()
+                    if square.rect.collidepoint(mx, my) and square.content == ' ' and current_player == "X":
+                        square.content = "X"
+                        board.play(square.number - 1, 0)
+                        square.update()
+                        game_over = check_winner() is not None
+                        current_player = "O" if not game_over else "X"
+                        if not game_over:
+                            ai_move()
+                            game_over = check_winner() is not None
+                            current_player = "X"
+
+            if event.type == pygame.KEYDOWN and game_over:
+                if event.key == pygame.K_r:
+                    board = Position()
+                    for square in squares:
+                        square.content = ' '
+                        square.update()
+                    current_player = "X"
+                    game_over = False
+
+        update_display()
+
+    pygame.quit()
+
+if __name__ == "__main__":
+    main()
+    sys.exit()
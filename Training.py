@@ -0,0 +1,216 @@
+import argparse
+import csv
+import json
+import os
+import shutil
+from datetime import datetime
+
+import numpy as np
+from stable_baselines3 import PPO
+from stable_baselines3.common.callbacks import BaseCallback
+from stable_baselines3.common.vec_env import VecMonitor
+
+from Env import ShardedTicTacToeVecEnv, TicTacToeVecEnv
+from Inference import zip_path
+
+METRICS_FIELDS = ["iteration", "mean_reward", "max_reward", "min_reward", "mean_length",
+                  "episode_count", "timesteps", "timestamp"]
+# One model per iteration goes to CHECKPOINT_DIR, next to a state file
+# recording the progress and the evaluation scores, so an interrupted run
+# can resume from its last completed iteration
+CHECKPOINT_DIR = "checkpoints"
+STATE_FILE = "state.json"
+KEEP_CHECKPOINTS = 3
+# Opponents of the evaluation run after each iteration
+EVALUATION_OPPONENTS = ("random", "minimax")
+# Every checkpoint meets the same openings and random moves. At 4000 games
+# per opponent the score of one checkpoint varies by about 0.008 from seed to
+# seed, so a gain of MIN_DELTA is well above that noise.
+EVALUATION_SEED = 0
+EVALUATION_GAMES = 4000
+MIN_DELTA = 0.03
+
+
+def make_training_env(workers=0, n_envs=64):
+    # The n_envs boards are stepped together, in this process or split
+    # between `workers` processes when workers > 1
+    if workers > 1:
+        return VecMonitor(ShardedTicTacToeVecEnv(workers, n_envs))
+    return VecMonitor(TicTacToeVecEnv(n_envs))
+
+
+# Collects finished episodes reported by Monitor/VecMonitor during learn()
+class EpisodeStatsCallback(BaseCallback):
+    def __init__(self):
+        super().__init__()
+        self.rewards = []
+        self.lengths = []
+
+    def _on_step(self):
+        for info in self.locals["infos"]:
+            episode = info.get("episode")
+            if episode:
+                self.rewards.append(episode["r"])
+                self.lengths.append(episode["l"])
+        return True
+
+    def pop_row(self, iteration, timesteps):
+        rewards = np.array(self.rewards or [0.0])
+        lengths = np.array(self.lengths or [0])
+        row = {
+            "iteration": iteration,
+            "mean_reward": float(rewards.mean()),
+            "max_reward": float(rewards.max()),
+            "min_reward": float(rewards.min()),
+            "mean_length": float(lengths.mean()),
+            "episode_count": len(self.rewards),
+            "timesteps": timesteps,
+            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        self.rewards = []
+        self.lengths = []
+        return row
+
+
+def append_metrics(path, row):
+    new_file = not os.path.exists(path)
+    with open(path, "a", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=METRICS_FIELDS)
+        if new_file:
+            writer.writeheader()
+        writer.writerow(row)
+
+
+def checkpoint_path(directory, iteration):
+    return os.path.join(directory, f"iteration_{iteration}")
+
+
+def load_state(directory):
+    path = os.path.join(directory, STATE_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(directory, state, keep=KEEP_CHECKPOINTS):
+    # Written after the checkpoint it names, and replaced in one rename, so
+    # a crash at any point leaves a state that can be resumed from
+    path = os.path.join(directory, STATE_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f, indent=1)
+    os.replace(path + ".tmp", path)
+    # Older checkpoints go, except the best one
+    for iteration in range(1, state["iteration"] - keep + 1):
+        old = zip_path(checkpoint_path(directory, iteration))
+        if iteration != state["best_iteration"] and os.path.exists(old):
+            os.remove(old)
+
+
+def evaluation_score(path, games=EVALUATION_GAMES, masked=True, seed=EVALUATION_SEED):
+    # Mean of (wins - losses) / games against each evaluation opponent: 1
+    # beats everyone, 0 only draws. A masked model is scored masked, as it
+    # plays in the game and the AI rooms; its logits for occupied cells were
+    # never trained. Unmasked, an illegal move counts as a loss.
+    from Evaluation import tournament
+    results, _ = tournament([f"ppo:{zip_path(path)}", *EVALUATION_OPPONENTS], games, workers=0,
+                            seed=seed, masked=masked)
+    scores = [result["win_rate"] - result["loss_rate"] for result in results
+              if result["agents"][0].startswith("ppo:")]
+    return sum(scores) / len(scores)
+
+
+def algorithm(masked=True):
+    # MaskablePPO samples only free cells, so no rollout is wasted on the
+    # illegal-move penalty; plain PPO remains available without sb3_contrib
+    if masked:
+        try:
+            from sb3_contrib import MaskablePPO
+            return MaskablePPO
+        except ImportError:
+            print("sb3_contrib is not installed, training without action masks")
+    return PPO
+
+
+def train_model(total_timesteps=50000, save_path="tictactoe_model", workers=0, n_envs=64,
+                n_steps=32, seed=0, iterations=1, metrics_path=None, masked=True,
+                checkpoint_dir=CHECKPOINT_DIR, resume=False, patience=3, min_delta=MIN_DELTA,
+                eval_games=EVALUATION_GAMES, keep=KEEP_CHECKPOINTS):
+    # After each iteration the model is checkpointed and played against
+    # EVALUATION_OPPONENTS; training stops early once the score has not
+    # improved by min_delta for `patience` iterations (0: never). The best
+    # checkpoint, not the last one, is saved to save_path.
+    env = make_training_env(workers, n_envs)
+    state = load_state(checkpoint_dir) if resume else None
+    if state:
+        model = algorithm(masked).load(checkpoint_path(checkpoint_dir, state["iteration"]), env=env)
+        print(f"Resuming from iteration {state['iteration']} in {checkpoint_dir}")
+    else:
+        model = algorithm(masked)("MlpPolicy", env, n_steps=n_steps, seed=seed, verbose=1)
+        state = {"iteration": 0, "best_iteration": None, "best_score": None, "stale": 0, "scores": {}}
+    stats = EpisodeStatsCallback()
+    timesteps_per_iteration = total_timesteps // iterations
+    try:
+        for iteration in range(state["iteration"] + 1, iterations + 1):
+            if patience and state["stale"] >= patience:
+                print(f"No progress for {state['stale']} iterations, stopping early")
+                break
+            model.learn(total_timesteps=timesteps_per_iteration, callback=stats,
+                        reset_num_timesteps=False)
+            row = stats.pop_row(iteration, timesteps_per_iteration)
+            print(f"Iteration {iteration}: mean reward {row['mean_reward']:.3f} "
+                  f"over {row['episode_count']} episodes")
+            if metrics_path:
+                append_metrics(metrics_path, row)
+
+            state["iteration"] = iteration
+            os.makedirs(checkpoint_dir, exist_ok=True)
+            model.save(checkpoint_path(checkpoint_dir, iteration))
+            score = evaluation_score(checkpoint_path(checkpoint_dir, iteration), eval_games, masked)
+            state["scores"][str(iteration)] = score
+            if state["best_score"] is None or score > state["best_score"] + min_delta:
+                state.update(best_iteration=iteration, best_score=score, stale=0)
+            else:
+                state["stale"] += 1
+            save_state(checkpoint_dir, state, keep)
+            print(f"Iteration {iteration}: evaluation score {score:+.3f} "
+                  f"(best {state['best_score']:+.3f} at iteration {state['best_iteration']})")
+    finally:
+        env.close()
+    if state["best_iteration"] is None:
+        model.save(save_path)
+    else:
+        shutil.copyfile(zip_path(checkpoint_path(checkpoint_dir, state["best_iteration"])), zip_path(save_path))
+    print(f"Model trained and saved to {save_path}")
+    return model
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train the Tic Tac Toe PPO agent")
+    parser.add_argument("--timesteps", type=int, default=100000, help="timesteps per iteration")
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=0,
+                        help="processes stepping the boards (0 or 1: all of them in this process)")
+    parser.add_argument("--n-envs", type=int, default=64, help="boards per step")
+    parser.add_argument("--n-steps", type=int, default=None, help="PPO steps per env per rollout")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save-path", default="tictactoe_model")
+    parser.add_argument("--metrics", default="training_metrics.csv")
+    parser.add_argument("--no-mask", dest="masked", action="store_false",
+                        help="train plain PPO without legal-action masks")
+    parser.add_argument("--checkpoint-dir", default=CHECKPOINT_DIR)
+    parser.add_argument("--resume", action="store_true",
+                        help="carry on from the last checkpoint in --checkpoint-dir")
+    parser.add_argument("--patience", type=int, default=3,
+                        help="stop after this many iterations without progress (0: never)")
+    parser.add_argument("--min-delta", type=float, default=MIN_DELTA,
+                        help="evaluation score gain that counts as progress")
+    parser.add_argument("--eval-games", type=int, default=EVALUATION_GAMES, help="evaluation games per opponent")
+    args = parser.parse_args()
+
+    n_steps = args.n_steps or max(2048 // args.n_envs, 16)
+    train_model(total_timesteps=args.timesteps * args.iterations, save_path=args.save_path,
+                workers=args.workers, n_envs=args.n_envs, n_steps=n_steps, seed=args.seed,
+                iterations=args.iterations, metrics_path=args.metrics, masked=args.masked,
+                checkpoint_dir=args.checkpoint_dir, resume=args.resume, patience=args.patience,
+                min_delta=args.min_delta, eval_games=args.eval_games)